@@ -17,8 +17,10 @@
     ],
     "data": [
         "security/ir.model.access.csv",
+        "data/ir_cron.xml",
         "wizard/export_with_pattern.xml",
         "wizard/import_pattern_wizard.xml",
+        "wizard/patterned_import_retry.xml",
         "views/pattern_import_export.xml",
         "views/patterned_import_export.xml",
     ],
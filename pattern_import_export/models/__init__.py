@@ -4,3 +4,8 @@ from . import ir_actions
 from . import base
 from . import ir_fields
 from . import patterned_import_export
+from . import patterned_import_row_hash
+from . import ir_attachment
+from . import patterned_import_partition
+from . import patterned_import_row
+from . import patterned_import_checkpoint
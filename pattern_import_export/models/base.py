@@ -1,14 +1,23 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import copy
+from collections import defaultdict
+from datetime import date, datetime
 
-from odoo import _, api, models
+import numpy
+
+from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
 from odoo.osv import expression
 
 from odoo.addons.queue_job.job import job
 
-from .common import IDENTIFIER_SUFFIX
+from .common import COLUMN_CONVERTED_TYPES, IDENTIFIER_SUFFIX, SCALAR_FIELD_TYPES
+
+TRUE_VALUES = ("1", "true", "yes", "=true()")
+FALSE_VALUES = ("0", "false", "no", "=false()")
+# type of the key fields of the one2many sub-items searched for a whole batch
+O2M_INDEX_KEY_TYPES = {"char": str, "selection": str, "integer": int}
 
 
 def is_not_empty(item):
@@ -26,6 +35,123 @@ def is_not_empty(item):
         return True
 
 
+def collect_xmlids(item, xmlids):
+    if isinstance(item, dict):
+        for key, value in item.items():
+            if key == "id" and isinstance(value, str):
+                if value:
+                    xmlids.add(value)
+            else:
+                collect_xmlids(value, xmlids)
+    elif isinstance(item, list):
+        for subitem in item:
+            collect_xmlids(subitem, xmlids)
+
+
+def collect_values(item, values):
+    """
+    Collect the values written by a row and its x2many sub-items,
+    the references to other records (dict) are skipped. Only the values
+    of the written fields are known, not the values computed from them.
+    """
+    for key, value in item.items():
+        if isinstance(value, list):
+            for subitem in value:
+                if isinstance(subitem, dict):
+                    collect_values(subitem, values)
+        elif not isinstance(value, dict) and value not in (None, ""):
+            key = key.replace(IDENTIFIER_SUFFIX, "")
+            values.add((key, value))
+            values.add((key, str(value)))
+
+
+def to_boolean(value):
+    if isinstance(value, (bool, int)):
+        return bool(value)
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise ValueError(value)
+
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return fields.Date.to_date(value)
+
+
+def cast_boolean(array):
+    strings = numpy.char.lower(array.astype(str))
+    true = numpy.isin(strings, TRUE_VALUES)
+    if not (true | numpy.isin(strings, FALSE_VALUES)).all():
+        raise ValueError(array)
+    return true
+
+
+def cast_date(array):
+    # like fields.Date.to_date only the first 10 characters are parsed
+    strings = array.astype("U10")
+    if not (numpy.char.str_len(strings) == 10).all():
+        raise ValueError(array)
+    return strings.astype("datetime64[D]")
+
+
+# vectorized cast of a whole column and conversion of a single cell
+COLUMN_CONVERTERS = {
+    "boolean": (cast_boolean, to_boolean),
+    "date": (cast_date, to_date),
+    "float": (lambda array: array.astype(float), float),
+    "integer": (lambda array: array.astype(numpy.int64), int),
+    "monetary": (lambda array: array.astype(float), float),
+}
+
+
+def cast_array(array, cast, convert):
+    """
+    Cast an array of values, if some values can not be cast the array is
+    split until they are isolated, they are then converted one by one
+    and kept if they can not be converted
+    @return: list of values
+    """
+    try:
+        return cast(array).tolist()
+    except (TypeError, ValueError, OverflowError):
+        if len(array) > 1:
+            middle = len(array) // 2
+            return cast_array(array[:middle], cast, convert) + cast_array(
+                array[middle:], cast, convert
+            )
+    value = array[0]
+    try:
+        return [convert(value)]
+    except (TypeError, ValueError, AttributeError):
+        return [value]
+
+
+def convert_column(field_type, values):
+    """
+    Convert the values of a column with a vectorized cast, the empty values
+    and the values which can not be converted are kept
+    @param field_type: type of the field of the column
+    @param values: list of values
+    @return: list of values
+    """
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    indexes = numpy.flatnonzero(
+        numpy.not_equal(array, None) & numpy.not_equal(array, "")
+    )
+    res = list(values)
+    if len(indexes):
+        cast, convert = COLUMN_CONVERTERS[field_type]
+        for idx, value in zip(indexes, cast_array(array[indexes], cast, convert)):
+            res[idx] = value
+    return res
+
+
 class Base(models.AbstractModel):
     _inherit = "base"
 
@@ -62,6 +188,9 @@ class Base(models.AbstractModel):
     @job(default_channel="root.exportwithpattern")
     def _generate_export_with_pattern_job(self, export_pattern):
         export = export_pattern._export_with_record(self)
+        return self._notify_export_result(export)
+
+    def _notify_export_result(self, export):
         if export.status == "success":
             self.env.user.notify_success(
                 message=_(
@@ -89,12 +218,379 @@ class Base(models.AbstractModel):
     # TODO try to reproduce it on native odoo and open a ticket
 
     def _load_records_write(self, values):
+        if self._context.get("load_format") == "flatty":
+            values = self._remove_unchanged_values(values)
+            if not values:
+                # nothing change, skip the write to avoid useless
+                # recomputation, tracking and write_date update
+                return
         return super()._load_records_write(copy.deepcopy(values))
 
     def _load_records_create(self, values):
         return super()._load_records_create(copy.deepcopy(values))
 
+    def _load_records(self, data_list, update=False):
+        if self._context.get("load_format") == "flatty":
+            # update the records by id order so concurrent imports
+            # lock the rows in the same order, new records stay at the end
+            xmlids = self._context.get("pattern_import_xmlids") or {}
+            items = sorted(
+                ((self._get_load_record_id(data, xmlids), data) for data in data_list),
+                key=lambda item: (item[0] is None, item[0] or 0),
+            )
+            data_list = [data for __, data in items]
+            self._prefetch_values_to_compare(
+                data_list, [record_id for record_id, __ in items if record_id]
+            )
+        return super()._load_records(data_list, update=update)
+
+    def _get_load_record_id(self, data, xmlids):
+        """
+        Return the id of the existing record updated by a row of the load,
+        identified by its database id or by its external id resolved with
+        the prefetched external ids, or None for a new record
+        @param xmlids: dict {xmlid: (model, res_id)}
+        """
+        record_id = data["values"].get("id")
+        if isinstance(record_id, int):
+            return record_id
+        model, record_id = xmlids.get(data.get("xml_id"), (None, None))
+        return record_id if model == self._name else None
+
+    def _prefetch_values_to_compare(self, data_list, ids):
+        """Read in one batch the current values of the records to update"""
+        fnames = set()
+        for data in data_list:
+            fnames.update(data["values"])
+        fnames = [
+            fname
+            for fname in fnames
+            if fname != "id"
+            and fname in self._fields
+            and (
+                self._fields[fname].type in SCALAR_FIELD_TYPES
+                or self._fields[fname].type in ("many2one", "many2many", "one2many")
+            )
+        ]
+        if ids and fnames:
+            records = self.browse(ids)
+            x2m_fnames = [
+                fname
+                for fname in fnames
+                if self._fields[fname].type in ("many2many", "one2many")
+            ]
+            records.read(
+                [fname for fname in fnames if fname not in x2m_fnames],
+                load="_classic_write",
+            )
+            if x2m_fnames:
+                # compared with the archived records included
+                records.with_context(active_test=False).read(
+                    x2m_fnames, load="_classic_write"
+                )
+
+    def _remove_unchanged_values(self, values):
+        """
+        Compare the converted values of an import with the values of the
+        record and only return the values that need to be written
+        @param values: dict of converted values
+        @return: dict
+        """
+        self.ensure_one()
+        res = {}
+        for fname, value in values.items():
+            field = self._fields.get(fname)
+            if fname == "id" or not field:
+                res[fname] = value
+                continue
+            if field.type == "many2one":
+                if (value or False) == self[fname].id:
+                    continue
+            elif field.type in ("one2many", "many2many"):
+                value = self._remove_unchanged_x2m_commands(field, value)
+                if not value:
+                    continue
+            elif field.type in SCALAR_FIELD_TYPES:
+                if field.convert_to_cache(value, self, validate=False) == self[fname]:
+                    continue
+            res[fname] = value
+        if list(res) == ["id"]:
+            return {}
+        return res
+
+    def _remove_unchanged_x2m_commands(self, field, commands):
+        if not isinstance(commands, list):
+            return commands
+        # the relation also links the archived records
+        current = self.with_context(active_test=False)[field.name]
+        res = []
+        for command in commands:
+            if command[0] == 4 and command[1] in current.ids:
+                continue
+            elif command[0] == 6 and set(command[2]) == set(current.ids):
+                continue
+            elif command[0] == 6 and field.type == "many2many":
+                # only link and unlink the changed records instead of
+                # deleting and inserting all the rows of the relation
+                new_ids = set(command[2])
+                current_ids = set(current.ids)
+                res += [(3, rec_id) for rec_id in current.ids if rec_id not in new_ids]
+                res += [
+                    (4, rec_id) for rec_id in command[2] if rec_id not in current_ids
+                ]
+                continue
+            elif command[0] == 1:
+                vals = current.browse(command[1])._remove_unchanged_values(command[2])
+                if not vals:
+                    continue
+                command = (1, command[1], vals)
+            res.append(command)
+        return res
+
     def _flatty2json(self, row):
+        return self._post_process_key(self._flatty2dict(row))
+
+    def _flatty2json_batch(self, rows):
+        """
+        Convert the rows like _flatty2json but the one2many sub-items
+        identified by key of the existing records are searched with
+        one query per one2many field for all the rows and the external ids
+        of all the rows are resolved with one query
+        @param rows: list of dict
+        @return: list of tuple (converted row, exception raised by the row)
+        """
+        items = []
+        for row in rows:
+            try:
+                items.append([self._flatty2dict(row), None])
+            except Exception as e:
+                items.append([None, e])
+        self._prefetch_import_xmlids([res for res, error in items if res])
+        pending_values = self._context.get("pattern_import_pending_values")
+        if pending_values is not None:
+            # values written by the rows, the records created by the
+            # previous rows only need to be flushed to find one of them
+            for res, error in items:
+                collect_values(res, pending_values)
+        key_index = self._get_key_index([res for res, error in items if res])
+        for item in items:
+            res = item[0]
+            if res is None:
+                continue
+            try:
+                domain_key, ident_keys = self._get_domain_from_identifier_key(res)
+                index_key = self._get_o2m_index_key(res)
+                if index_key:
+                    # the record was searched with the other rows
+                    self._set_record_id(
+                        res, ident_keys, self.browse(key_index.get(index_key, []))
+                    )
+                elif domain_key:
+                    self._set_record_id_from_domain(res, ident_keys, domain_key)
+            except Exception as e:
+                item[:] = [None, e]
+        o2m_index = self._get_o2m_key_index([res for res, error in items if res])
+        for item in items:
+            res = item[0]
+            if res is None:
+                continue
+            try:
+                self._post_process_o2m_fields(
+                    res, parent_do_not_exist=False, o2m_index=o2m_index
+                )
+                __, ident_keys = self._get_domain_from_identifier_key(res)
+                self._clean_identifier_key(res, ident_keys)
+            except Exception as e:
+                item[:] = [None, e]
+        return items
+
+    def _prefetch_import_xmlids(self, items):
+        """
+        Resolve with one query the external ids of the rows (of the records
+        and of the related records) and store them in the prefetched
+        external ids of the context, read by the converter before its
+        import cache (bounded, it can not keep a whole chunk)
+        @param items: list of dict
+        """
+        prefetched = self._context.get("pattern_import_xmlids")
+        if prefetched is None:
+            return
+        module = self._context.get("_import_current_module", "")
+        xmlids = set()
+        for res in items:
+            collect_xmlids(res, xmlids)
+        xmlids = {
+            xmlid if "." in xmlid else "{}.{}".format(module, xmlid) for xmlid in xmlids
+        } - set(prefetched)
+        if not xmlids:
+            return
+        self.env.cr.execute(
+            """SELECT module, name, model, res_id FROM ir_model_data
+            WHERE (module, name) IN %s""",
+            (tuple(tuple(xmlid.split(".", 1)) for xmlid in xmlids),),
+        )
+        by_model = defaultdict(dict)
+        for module, name, model, res_id in self.env.cr.fetchall():
+            by_model[model]["{}.{}".format(module, name)] = res_id
+        for model, res_ids in by_model.items():
+            if model not in self.env:
+                continue
+            # like the converter, ignore the external ids of deleted records
+            self.env.cr.execute(
+                'SELECT id FROM "{}" WHERE id IN %s'.format(self.env[model]._table),
+                (tuple(res_ids.values()),),
+            )
+            existing_ids = {row[0] for row in self.env.cr.fetchall()}
+            for xmlid, res_id in res_ids.items():
+                if res_id in existing_ids:
+                    prefetched[xmlid] = (model, res_id)
+
+    def _get_o2m_index_key(self, res):
+        """
+        Return the key of a sub-item which can be matched with the index
+        of the one2many sub-items, or None
+        """
+        key = []
+        for name, value in res.items():
+            if not name.endswith(IDENTIFIER_SUFFIX):
+                continue
+            field = self._fields.get(name[: -len(IDENTIFIER_SUFFIX)])
+            if (
+                not field
+                or field.translate
+                or type(value) is not O2M_INDEX_KEY_TYPES.get(field.type)
+            ):
+                return None
+            key.append((field.name, value))
+        return tuple(sorted(key)) or None
+
+    def _get_key_index(self, items):
+        """
+        Search the existing records identified by key of the rows with
+        one query per set of key fields
+        @param items: list of dict
+        @return: dict {key: list of ids}
+        """
+        to_search = defaultdict(lambda: defaultdict(set))
+        for res in items:
+            key = self._get_o2m_index_key(res)
+            if key:
+                values = to_search[tuple(fname for fname, __ in key)]
+                for fname, value in key:
+                    values[fname].add(value)
+        index = defaultdict(list)
+        for key_fields, values in to_search.items():
+            domain = [(fname, "in", list(values[fname])) for fname in key_fields]
+            for vals in self.search(domain).read(
+                list(key_fields), load="_classic_write"
+            ):
+                key = tuple((fname, vals[fname]) for fname in key_fields)
+                index[key].append(vals["id"])
+        return index
+
+    def _collect_subfield_references(self, res, references):
+        """
+        Collect the values of the records referenced by a subfield
+        (ex: country_id|code) of a row and of its one2many sub-items
+        @param res: dict, the converted row
+        @param references: dict {(field, subfield): set of values}
+        """
+        for name, value in res.items():
+            field = self._fields.get(name)
+            if not field or not field.relational or not value:
+                continue
+            if field.type == "one2many":
+                comodel = self.env[field.comodel_name]
+                for subitem in value:
+                    if isinstance(subitem, dict):
+                        comodel._collect_subfield_references(subitem, references)
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                if not isinstance(item, dict) or len(item) != 1:
+                    continue
+                [(subfield, subvalue)] = item.items()
+                if subfield not in ("id", ".id") and isinstance(subvalue, (str, int)):
+                    references[(field, subfield)].add(subvalue)
+
+    def _prefetch_subfield_references(self, items):
+        """
+        Search the records referenced by a subfield in the rows with one
+        query per field and subfield, used by the converter instead of
+        one search per value
+        @param items: list of dict
+        @return: dict {(model, field name, subfield): (searched values,
+            dict {value: list of ids})}
+        """
+        to_search = defaultdict(set)
+        for res in items:
+            self._collect_subfield_references(res, to_search)
+        references = {}
+        for (field, subfield), values in to_search.items():
+            comodel = self.env[field.comodel_name]
+            sub_field = comodel._fields.get(subfield)
+            if (
+                not sub_field
+                or not sub_field.store
+                or sub_field.translate
+                or sub_field.type not in O2M_INDEX_KEY_TYPES
+            ):
+                continue
+            value_type = O2M_INDEX_KEY_TYPES[sub_field.type]
+            values = {value for value in values if type(value) is value_type}
+            if not values:
+                continue
+            # Only list domain are supported as they can be apply on server-side
+            domain = field.domain if isinstance(field.domain, list) else []
+            records = comodel.search(
+                expression.AND([domain, [(subfield, "in", list(values))]])
+            )
+            index = defaultdict(list)
+            for vals in records.read([subfield], load="_classic_write"):
+                index[vals[subfield]].append(vals["id"])
+            references[(field.model_name, field.name, subfield)] = values, index
+        return references
+
+    def _get_o2m_key_index(self, items):
+        """
+        Search the existing one2many sub-items identified by key of the
+        records with one query per one2many field and key fields
+        @param items: list of dict, the rows with their record id resolved
+        @return: dict {(field name, parent id, key): list of ids}
+        """
+        to_search = defaultdict(lambda: (set(), defaultdict(set)))
+        for res in items:
+            parent_id = self._get_flatty_record_id(res, raise_if_not_found=False)
+            if not parent_id:
+                continue
+            for name, subitems in res.items():
+                field = self._fields.get(name)
+                if not field or field.type != "one2many":
+                    continue
+                comodel = self.env[field.comodel_name]
+                for subitem in subitems:
+                    key = comodel._get_o2m_index_key(subitem)
+                    if key:
+                        parent_ids, values = to_search[
+                            (name, tuple(fname for fname, __ in key))
+                        ]
+                        parent_ids.add(parent_id)
+                        for fname, value in key:
+                            values[fname].add(value)
+        index = defaultdict(list)
+        for (name, key_fields), (parent_ids, values) in to_search.items():
+            field = self._fields[name]
+            domain = [(field.inverse_name, "in", list(parent_ids))]
+            for fname in key_fields:
+                domain.append((fname, "in", list(values[fname])))
+            records = self.env[field.comodel_name].search(domain)
+            for vals in records.read(
+                [field.inverse_name] + list(key_fields), load="_classic_write"
+            ):
+                key = tuple((fname, vals[fname]) for fname in key_fields)
+                index[(name, vals[field.inverse_name], key)].append(vals["id"])
+        return index
+
+    def _flatty2dict(self, row):
         for key in ["id", ".id"]:
             if key in row and row[key] is None:
                 row.pop(key)
@@ -124,7 +620,7 @@ class Base(models.AbstractModel):
                     current = current[previous_key]
                 previous_key = key
             current[keys[-1]] = vals
-        return self._post_process_key(res)
+        return res
 
     def _clean_identifier_key(self, res, ident_keys):
         for key in ident_keys:
@@ -152,13 +648,20 @@ class Base(models.AbstractModel):
                 ident_keys.append(key)
         return domain, ident_keys
 
-    def _post_process_o2m_fields(self, res, parent_do_not_exist):
+    def _get_flatty_record_id(self, res, raise_if_not_found=True):
         if ".id" in res:
-            parent_id = res[".id"]
+            return res[".id"]
         elif "id" in res:
-            parent_id = self.env.ref(res["id"]).id
+            cached = self._context.get("pattern_import_xmlids", {}).get(res["id"])
+            if cached and cached[0] == self._name:
+                return cached[1]
+            record = self.env.ref(res["id"], raise_if_not_found=raise_if_not_found)
+            return record and record.id
         else:
-            parent_id = None
+            return None
+
+    def _post_process_o2m_fields(self, res, parent_do_not_exist, o2m_index=None):
+        parent_id = self._get_flatty_record_id(res)
 
         for key in res:
             field = self._fields.get(key)
@@ -168,16 +671,40 @@ class Base(models.AbstractModel):
                     subdomain.append((field.inverse_name, "=", parent_id))
                 # empty subitem are removed
                 valid_subitems = []
+                comodel = self.env[field._related_comodel_name]
                 for subitem in res[key]:
-                    if is_not_empty(subitem):
-                        valid_subitems.append(subitem)
-                        self.env[field._related_comodel_name]._post_process_key(
+                    if not is_not_empty(subitem):
+                        continue
+                    valid_subitems.append(subitem)
+                    index_key = (
+                        parent_id
+                        and o2m_index is not None
+                        and comodel._get_o2m_index_key(subitem)
+                    )
+                    if index_key:
+                        # the sub-item was searched with the other rows
+                        __, ident_keys = comodel._get_domain_from_identifier_key(
+                            subitem
+                        )
+                        comodel._set_record_id(
+                            subitem,
+                            ident_keys,
+                            comodel.browse(
+                                o2m_index.get((key, parent_id, index_key), [])
+                            ),
+                        )
+                        comodel._post_process_o2m_fields(subitem, False)
+                        comodel._clean_identifier_key(subitem, ident_keys)
+                    else:
+                        comodel._post_process_key(
                             subitem, subdomain, not bool(parent_id)
                         )
                 res[key] = valid_subitems
 
     def _set_record_id_from_domain(self, res, ident_keys, domain):
-        record = self.search(domain)
+        self._set_record_id(res, ident_keys, self.search(domain))
+
+    def _set_record_id(self, res, ident_keys, record):
         if len(record) > 1:
             raise ValidationError(
                 _("Too many {} found for the key/value : {}").format(
@@ -208,13 +735,81 @@ class Base(models.AbstractModel):
             if key.startswith("#"):
                 row.pop(key)
 
+    def _convert_flatty_columns(self, rows):
+        """
+        Convert column by column the numeric, date and boolean fields of the
+        model, the converter of the rows then skip the converted values.
+        The values which can not be converted are kept, so they are
+        reported as error on their row by the converter.
+        @param rows: list of dict
+        """
+        headers = {header for row in rows for header in row}
+        for header in headers:
+            field = self._fields.get(header)
+            if not field or field.type not in COLUMN_CONVERTED_TYPES:
+                continue
+            values = convert_column(field.type, [row.get(header) for row in rows])
+            for row, value in zip(rows, values):
+                if header in row:
+                    row[header] = value
+
+    @api.model
+    def _validate_flatty_rows(self, rows):
+        """
+        Parse and convert the rows like the flatty import does but without
+        writing anything
+        @param rows: list of tuple (row number, row)
+        @return: list of messages (same format as the load messages)
+        """
+        messages = []
+        not_empty_rows = []
+        for row_number, row in rows:
+            self._remove_commented_columns(row)
+            if any(row.values()):
+                not_empty_rows.append((row_number, row))
+        self._convert_flatty_columns([row for __, row in not_empty_rows])
+
+        def extract():
+            records = model._flatty2json_batch([row for __, row in not_empty_rows])
+            references.update(
+                model._prefetch_subfield_references(
+                    [record for record, error in records if record]
+                )
+            )
+            for (row_number, __), (record, error) in zip(not_empty_rows, records):
+                info = {"rows": {"from": row_number, "to": row_number}}
+                if error:
+                    messages.append(dict(info, type="error", message=str(error)))
+                    continue
+                yield record, info
+
+        # nothing is written so there is nothing to flush before searching
+        # the referenced records and they can be searched for all the rows
+        references = {}
+        model = self.with_context(
+            import_flush=lambda **kwargs: None,
+            pattern_import_xmlids={},
+            pattern_import_references=references,
+        )
+        for __ in model._convert_records(extract(), log=messages.append):
+            pass
+        return messages
+
     @api.model
     def _extract_records(self, fields_, data, log=lambda a: None):
         if self._context.get("load_format") == "flatty":
-            for idx, row in enumerate(data):
+            # rows imported by chunks keep the line number in the file
+            row_offset = self._context.get("pattern_import_row_offset", 0)
+            rows = []
+            for idx, row in enumerate(data, start=row_offset + 1):
                 self._remove_commented_columns(row)
-                if not any(row.values()):
-                    continue
-                yield self._flatty2json(row), {"rows": {"from": idx + 1, "to": idx + 1}}
+                if any(row.values()):
+                    rows.append((idx, row))
+            self._convert_flatty_columns([row for __, row in rows])
+            records = self._flatty2json_batch([row for __, row in rows])
+            for (idx, __), (record, error) in zip(rows, records):
+                if error:
+                    raise error
+                yield record, {"rows": {"from": idx, "to": idx}}
         else:
             yield from super()._extract_records(fields_, data, log=log)
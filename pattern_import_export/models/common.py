@@ -1,5 +1,120 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import gc
+import itertools
+import os
+from datetime import date
+
+import psutil
+
+from odoo.tools import config
 
 IDENTIFIER_SUFFIX = "#key"
 COLUMN_X2M_SEPARATOR = "|"
+# column of the separate sheets of one2many giving the row of the parent record
+O2M_SHEET_PARENT_ROW = "#parent_row"
+# column of the patch files of an import giving the line of the row to replace
+STAGED_ROW_NUMBER = "#line"
+
+# Field types whose value is directly exported and imported
+SCALAR_FIELD_TYPES = (
+    "boolean",
+    "char",
+    "date",
+    "datetime",
+    "float",
+    "integer",
+    "monetary",
+    "selection",
+    "text",
+)
+
+# Python type of the values of the columns converted before the import
+COLUMN_CONVERTED_TYPES = {
+    "boolean": bool,
+    "date": date,
+    "float": float,
+    "integer": int,
+    "monetary": float,
+}
+
+
+class MemoryGovernor(object):
+    """
+    Split the records or rows processed by a job in chunks whose size is
+    adapted to the memory used by the worker. The cache of the environment
+    is cleared between two chunks so a long job stays under
+    limit_memory_soft instead of being killed at limit_memory_hard.
+    Odoo checks these limits against the virtual memory of the worker so
+    it is also the value used here.
+    """
+
+    def __init__(self, env, chunk_size=1000, min_chunk_size=10, max_chunk_size=10000):
+        self.env = env
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.soft_limit = config.get("limit_memory_soft") or 0
+        self.hard_limit = config.get("limit_memory_hard") or 0
+        self.nbr_chunks = 0
+        self.start_rss, self.start_vms = self._get_memory()
+        self.peak_rss, self.peak_vms = self.start_rss, self.start_vms
+        self.changes = []
+
+    def _get_memory(self):
+        info = psutil.Process(os.getpid()).memory_info()
+        return info.rss, info.vms
+
+    def split(self, items):
+        """
+        @param items: list or iterator
+        @return: iterator of list
+        """
+        iterator = iter(items)
+        while True:
+            chunk = list(itertools.islice(iterator, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Called once a chunk is processed"""
+        self.nbr_chunks += 1
+        self.env.invalidate_all()
+        rss, vms = self._get_memory()
+        if self.soft_limit and vms > self.soft_limit * 0.8:
+            gc.collect()
+            rss, vms = self._get_memory()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_vms = max(self.peak_vms, vms)
+        chunk_size = self.chunk_size
+        if self.hard_limit and vms > self.hard_limit * 0.9:
+            chunk_size = self.min_chunk_size
+        elif self.soft_limit and vms > self.soft_limit * 0.8:
+            chunk_size = chunk_size // 2
+        elif self.soft_limit and vms < self.soft_limit * 0.5:
+            chunk_size = chunk_size * 2
+        chunk_size = min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+        if chunk_size != self.chunk_size:
+            self.changes.append((self.nbr_chunks, vms, chunk_size))
+            self.chunk_size = chunk_size
+
+    def get_profile(self):
+        mb = 1024 * 1024
+        lines = [
+            "Chunks: {}, RSS start/peak: {}/{} Mb, virtual start/peak: {}/{} Mb".format(
+                self.nbr_chunks,
+                self.start_rss // mb,
+                self.peak_rss // mb,
+                self.start_vms // mb,
+                self.peak_vms // mb,
+            )
+        ]
+        for nbr_chunks, vms, chunk_size in self.changes:
+            lines.append(
+                "After chunk {} ({} Mb): chunk size {}".format(
+                    nbr_chunks, vms // mb, chunk_size
+                )
+            )
+        return "\n".join(lines)
@@ -0,0 +1,65 @@
+# Copyright 2020 Akretion France (http://www.akretion.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import base64
+import hashlib
+import os
+import tempfile
+
+from odoo import api, models
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class IrAttachment(models.Model):
+    _inherit = "ir.attachment"
+
+    @api.multi
+    def _set_datas_from_file(self, fileobj):
+        """
+        Store the content of a binary file object as the content of the
+        attachment. When the attachments are stored in the filestore the
+        file is copied by chunks so its content is never fully loaded
+        in memory.
+        @param fileobj: binary file object
+        @return: bool
+        """
+        self.ensure_one()
+        fileobj.seek(0)
+        if self._storage() == "db":
+            self.datas = base64.b64encode(fileobj.read())
+            return True
+        filestore = self._full_path("")
+        if not os.path.isdir(filestore):
+            os.makedirs(filestore)
+        checksum = hashlib.sha1()
+        file_size = 0
+        tmp = tempfile.NamedTemporaryFile(dir=filestore, delete=False)
+        try:
+            with tmp:
+                for chunk in iter(lambda: fileobj.read(COPY_CHUNK_SIZE), b""):
+                    checksum.update(chunk)
+                    file_size += len(chunk)
+                    tmp.write(chunk)
+            checksum = checksum.hexdigest()
+            fname, full_path = self._get_path(None, checksum)
+            if not os.path.exists(full_path):
+                os.rename(tmp.name, full_path)
+                # as done by _file_write, the file is removed by the garbage
+                # collector if the transaction aborts
+                self._mark_for_gc(fname)
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        if self.store_fname:
+            self._file_delete(self.store_fname)
+        # file_size and checksum are dropped by create and write
+        self.env.cr.execute(
+            """UPDATE ir_attachment
+            SET store_fname = %s, file_size = %s, checksum = %s, db_datas = NULL
+            WHERE id = %s""",
+            (fname, file_size, checksum, self.id),
+        )
+        self.invalidate_cache(
+            ["datas", "store_fname", "file_size", "checksum", "db_datas"], self.ids
+        )
+        return True
@@ -1,13 +1,45 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import base64
+import csv
+import hashlib
+import itertools
+import json
+import queue
+import re
+import tempfile
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
 
-from odoo import _, api, fields, models
-from odoo.exceptions import UserError
+from psycopg2 import OperationalError
+
+from odoo import _, api, fields, models, sql_db
+from odoo.exceptions import AccessError, UserError, ValidationError
+from odoo.osv import expression
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+from odoo.tools import split_every
+from odoo.tools.sql import create_index
 
 from odoo.addons.queue_job.job import job
 
-from .common import COLUMN_X2M_SEPARATOR, IDENTIFIER_SUFFIX
+from .common import (
+    COLUMN_X2M_SEPARATOR,
+    IDENTIFIER_SUFFIX,
+    SCALAR_FIELD_TYPES,
+    STAGED_ROW_NUMBER,
+    MemoryGovernor,
+)
+
+# characters not allowed in the name of a sheet and its maximum length in excel
+SHEET_NAME_FORBIDDEN_CHARS = re.compile(r"[/\\\[\]:*?]")
+SHEET_NAME_MAX_LENGTH = 31
+DRY_RUN_CHUNK_SIZE = 1000
+STAGING_CHUNK_SIZE = 1000
+# marks the end of the rows sent to the writer thread of an export
+END_OF_ROWS = object()
 
 
 class IrExports(models.Model):
@@ -15,7 +47,7 @@ class IrExports(models.Model):
     Todo: description:
     Add selection options on field export_format
     To implements:
-    _export_with_record_FORMAT (should use an iterator)
+    _export_rows_FORMAT (write the rows into a file object)
     _read_import_data_FORMAT (should return an iterator)
     """
 
@@ -34,6 +66,63 @@ class IrExports(models.Model):
     count_pattimpex_pending = fields.Integer(compute="_compute_pattimpex_counts")
     count_pattimpex_success = fields.Integer(compute="_compute_pattimpex_counts")
     pattimpex_ids = fields.One2many("patterned.import.export", "export_id")
+    skip_unchanged_rows = fields.Boolean(
+        help="Keep a hash of each imported row (identified by its id, .id or "
+        "key columns) and skip the rows that did not change since the last "
+        "successful import"
+    )
+
+    use_export_cache = fields.Boolean(
+        string="Reuse identical exports",
+        help="Return the last export of the same records if neither the "
+        "pattern nor the exported data changed since",
+    )
+    stage_import_rows = fields.Boolean(
+        string="Keep the imported rows",
+        help="Store the rows of the imported files and import them by chunks: "
+        "the chunks without error are kept and the failed rows can be imported "
+        "again, with corrected values, without the rest of the file. "
+        "Not available with parallel import jobs.",
+    )
+    pipelined_export = fields.Boolean(
+        string="Write the file in background",
+        help="Write the exported file in a separate thread while the next "
+        "records are read, the rows waiting to be written are limited. "
+        "The writer of the format must not use the ORM.",
+    )
+    resumable_import = fields.Boolean(
+        help="Commit the imported rows by chunks: if the import job is "
+        "restarted, it resumes after the last committed chunk. The chunks "
+        "without error are kept even if other chunks fail. Not available "
+        "with parallel import jobs."
+    )
+    bulk_import = fields.Boolean(
+        string="Bulk import",
+        help="Import without tracking the changes in the chatter and compute "
+        "the stored computed fields once per chunk of rows instead of "
+        "after each created or updated record",
+    )
+    raw_create = fields.Boolean(
+        string="Raw bulk create",
+        help="Only create records, inserted directly in the database without "
+        "the logic of the model. Only available for the models without any "
+        "logic on create and the patterns of stored fields and many2one. "
+        "The default values are computed once per chunk of rows.",
+    )
+    export_xmlid = fields.Boolean(
+        string="Export external ids",
+        help="Export the id column as external ids instead of database ids, "
+        "the missing external ids are generated",
+    )
+    import_job_count = fields.Integer(
+        string="Parallel import jobs",
+        default=1,
+        help="Split the imported files in this number of jobs. The rows "
+        "updating the same record (same id or key) are always imported by "
+        "the same job.",
+    )
+
+    key_index_warning = fields.Text(compute="_compute_key_index_warning")
 
     def _compute_pattimpex_counts(self):
         for rec in self:
@@ -75,6 +164,140 @@ class IrExports(models.Model):
             "domain": [("id", "in", ids)],
         }
 
+    @api.depends("export_fields.is_key", "export_fields.name")
+    def _compute_key_index_warning(self):
+        for rec in self:
+            messages = []
+            for model, field_name, column in rec._get_missing_key_indexes():
+                if column:
+                    message = _(
+                        "The field '{}' of '{}' is used as key but is not "
+                        "indexed, each imported row will scan the whole table"
+                    )
+                else:
+                    message = _(
+                        "The field '{}' of '{}' is used as key but is not "
+                        "stored, it can not be indexed"
+                    )
+                messages.append(message.format(field_name, model))
+            rec.key_index_warning = "\n".join(messages) or False
+
+    def _get_key_lookup_fields(self, visited=None):
+        """
+        Return the fields searched during the import to find the existing
+        records from the key columns (including the one of the sub-patterns)
+        @return: list of tuple (model name, field name)
+        """
+        self.ensure_one()
+        if visited is None:
+            visited = set()
+        visited.add(self.id)
+        result = []
+        for line in self.export_fields:
+            if not line.name:
+                continue
+            if line.is_key:
+                result += line._get_key_lookup_fields()
+            sub_pattern = line.pattern_export_id
+            if sub_pattern and sub_pattern.id not in visited:
+                sub_result = sub_pattern._get_key_lookup_fields(visited)
+                if sub_result:
+                    # sub-items are searched with their parent
+                    field_name, model, __ = line._get_last_relation_field(
+                        self.resource, line.name
+                    )
+                    field = self.env[model]._fields[field_name]
+                    if field.type == "one2many":
+                        result.append((field.comodel_name, field.inverse_name))
+                    result += sub_result
+        return list(dict.fromkeys(result))
+
+    def _get_key_column(self, model, field_name):
+        """
+        @return: tuple (table, column) where column is False if the field
+        is not stored or None if there is nothing to index
+        """
+        field = self.env[model]._fields[field_name]
+        if field.type in ("one2many", "many2many"):
+            return None
+        if field.inherited:
+            field = field.related_field
+        table = self.env[field.model_name]._table
+        if not field.store or not field.column_type:
+            return table, False
+        return table, field.name
+
+    def _column_is_indexed(self, table, column):
+        self.env.cr.execute(
+            """
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[0]
+            WHERE t.relname = %s AND a.attname = %s
+                AND i.indisvalid AND i.indisready
+            LIMIT 1
+            """,
+            (table, column),
+        )
+        return bool(self.env.cr.fetchone())
+
+    def _get_missing_key_indexes(self):
+        """
+        @return: list of tuple (model name, field name, column) for the key
+        fields without index. column is False if the field is not stored
+        """
+        self.ensure_one()
+        result = []
+        for model, field_name in self._get_key_lookup_fields():
+            key_column = self._get_key_column(model, field_name)
+            if key_column is None:
+                continue
+            table, column = key_column
+            if not column or not self._column_is_indexed(table, column):
+                result.append((model, field_name, column))
+        return result
+
+    @job
+    def _create_key_index_job(self, table, column):
+        """
+        Build the index of a key column without locking the writes on the
+        table. A concurrent build waits for all the transactions started
+        before it, so it is done by a job, once the transaction requesting
+        it is committed, after ending the transaction of the job itself.
+        """
+        if self._column_is_indexed(table, column):
+            return True
+        index_name = "{}_{}_pattern_key_index".format(table, column)[:63]
+        if self.env.registry.in_test_mode():
+            # the tests run in one transaction which can not be committed
+            create_index(self.env.cr, index_name, table, ['"{}"'.format(column)])
+            return True
+        self.env.cr.commit()
+        with sql_db.db_connect(self.env.cr.dbname).cursor() as cr:
+            cr.autocommit(True)
+            # an interrupted concurrent build leaves an invalid index
+            cr.execute('DROP INDEX CONCURRENTLY IF EXISTS "{}"'.format(index_name))
+            cr.execute(
+                'CREATE INDEX CONCURRENTLY "{}" ON "{}" ("{}")'.format(
+                    index_name, table, column
+                )
+            )
+        return True
+
+    @api.multi
+    def button_create_key_indexes(self):
+        if not self.env.user.has_group("base.group_system"):
+            raise AccessError(_("Only the administrator can create indexes"))
+        for rec in self:
+            for model, field_name, __ in rec._get_missing_key_indexes():
+                table, column = rec._get_key_column(model, field_name)
+                if column:
+                    rec.with_delay(
+                        description=_("Create the index of {}.{}").format(table, column)
+                    )._create_key_index_job(table, column)
+        return True
+
     @property
     def row_start_records(self):
         return self.nr_of_header_rows + 1
@@ -117,19 +340,359 @@ class IrExports(models.Model):
         return True
 
     @api.multi
-    def _get_data_to_export(self, records):
+    def _get_data_to_export(self, records, governor=None, domain=None):
         """
         Iterator who built data dict record by record.
         This function could be recursive in case of sub-pattern
+        @param governor: MemoryGovernor splitting the records in chunks
+        @param domain: export the records matching the domain instead
+        of the given records
         """
         self.ensure_one()
+        if governor is None:
+            governor = MemoryGovernor(self.env)
+        if domain is None:
+            chunks = self._get_record_chunks(records, governor)
+        else:
+            chunks = self._search_record_chunks(domain, governor)
+        flat_fields = self._get_flat_fields()
+        if flat_fields:
+            yield from self._get_flat_data_to_export(chunks, flat_fields)
+            return
         json_parser = self.export_fields._get_json_parser_for_pattern()
-        for record in records:
-            yield self._get_data_to_export_by_record(record, json_parser)
+        limits = self.export_fields._get_x2many_limits_for_pattern()
+        headers = self._get_header()
+        sheet_lines = [
+            (line.field1_id.name, line.pattern_export_id)
+            for line in self._get_o2m_sheet_lines()
+        ]
+        sheet_headers = {
+            field_name: sub_pattern._get_header()
+            for field_name, sub_pattern in sheet_lines
+        }
+        for chunk in chunks:
+            xmlids = self._get_export_xmlids(chunk) if "id" in headers else {}
+            for data in self._jsonify_with_limits(chunk, json_parser, limits):
+                if data.get("id") in xmlids:
+                    data["id"] = xmlids[data["id"]]
+                row = self.json2flatty(data, headers=headers)
+                # the related records exported on a separate sheet
+                # are given as a list of rows
+                for field_name, sub_pattern in sheet_lines:
+                    row[field_name] = [
+                        sub_pattern.json2flatty(
+                            child_data, headers=sheet_headers[field_name]
+                        )
+                        for child_data in data.get(field_name) or []
+                    ]
+                yield row
+
+    def _get_export_xmlids(self, records):
+        """
+        Return the external ids of the records if the pattern exports them.
+        The missing external ids are created with one insert, named like
+        the ones generated by the native export.
+        @return: dict {record id: external id}
+        """
+        if not self.export_xmlid or not records:
+            return {}
+        cr = self.env.cr
+        cr.execute(
+            """SELECT res_id, module, name FROM ir_model_data
+            WHERE model = %s AND res_id IN %s ORDER BY id""",
+            (records._name, tuple(records.ids)),
+        )
+        xmlids = {}
+        for res_id, module, name in cr.fetchall():
+            xmlids.setdefault(res_id, "{}.{}".format(module, name))
+        missing = {
+            res_id: "__export__.{}_{}_{}".format(
+                records._table, res_id, uuid.uuid4().hex[:8]
+            )
+            for res_id in records.ids
+            if res_id not in xmlids
+        }
+        self._create_xmlids(records._name, missing)
+        xmlids.update(missing)
+        return xmlids
+
+    @api.model
+    def _create_xmlids(self, model_name, xmlids):
+        """
+        Create the external ids of records with one insert
+        @param xmlids: dict {record id: external id}
+        """
+        if not xmlids:
+            return
+        values = [
+            tuple(xmlid.split(".", 1)) + (model_name, res_id)
+            for res_id, xmlid in xmlids.items()
+        ]
+        self.env.cr.execute(
+            "INSERT INTO ir_model_data (module, name, model, res_id) "
+            "VALUES {}".format(", ".join(["%s"] * len(values))),
+            values,
+        )
+        self.env["ir.model.data"].invalidate_cache(
+            ["module", "model", "name", "res_id"]
+        )
+
+    def _get_record_chunks(self, records, governor):
+        for ids in governor.split(records.ids):
+            # browse from a new environment model to only prefetch the chunk
+            yield records.env[records._name].browse(ids)
+
+    def _search_record_chunks(self, domain, governor):
+        """
+        Search the records by chunks ordered by id, each search starting
+        after the last id of the previous chunk, so the ids of all the records
+        are never loaded at once and the searches stay fast (no offset)
+        """
+        model = self.env[self.resource]
+        last_id = 0
+        while True:
+            chunk = model.search(
+                expression.AND([domain, [("id", ">", last_id)]]),
+                order="id",
+                limit=governor.chunk_size,
+            )
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk.ids[-1]
+            governor.checkpoint()
+
+    def _get_o2m_sheet_lines(self):
+        return self.export_fields.filtered(lambda line: line.o2m_layout == "sheet")
+
+    def _get_o2m_sheet_names(self):
+        """
+        Choose the name of the sheets of the one2many: the name of their
+        sub-pattern without the characters forbidden by excel, limited to
+        31 characters and different from the names of the other sheets
+        @return: dict {export line: sheet name}
+        """
+        self.ensure_one()
+        # excel compares the names of the sheets case-insensitively
+        used_names = {self.name.lower()} | {
+            line._get_tab_name().lower()
+            for line in self.export_fields
+            if line.add_select_tab
+        }
+        names = {}
+        for line in self._get_o2m_sheet_lines():
+            base_name = (
+                SHEET_NAME_FORBIDDEN_CHARS.sub("_", line.pattern_export_id.name).strip(
+                    "'"
+                )[:SHEET_NAME_MAX_LENGTH]
+                or line.field1_id.name[:SHEET_NAME_MAX_LENGTH]
+            )
+            name = base_name
+            idx = 1
+            while name.lower() in used_names:
+                idx += 1
+                suffix = " ({})".format(idx)
+                name = base_name[: SHEET_NAME_MAX_LENGTH - len(suffix)] + suffix
+            used_names.add(name.lower())
+            names[line] = name
+        return names
+
+    def _get_o2m_sheets_metadata(self):
+        """
+        Collect the information of the sheets of the one2many, the writers
+        create the sheets with these names and the readers read them
+        @return: list of dict
+        """
+        self.ensure_one()
+        sheet_names = self._get_o2m_sheet_names()
+        return [
+            {
+                "name": sheet_names[line],
+                "key": line.field1_id.name,
+                "headers": line.pattern_export_id._get_header(),
+                "description_headers": self.use_description
+                and [_("Parent row")]
+                + line.pattern_export_id._get_header(use_description=True)
+                or [],
+            }
+            for line in self._get_o2m_sheet_lines()
+        ]
+
+    def _merge_o2m_sheet_rows(self, row, child_rows):
+        """
+        Add to a row the rows of its related records read on separate sheets,
+        with the same columns as the columns layout
+        @param row: dict
+        @param child_rows: dict {field name: list of dict}
+        @return: dict
+        """
+        for field_name, rows in child_rows.items():
+            for idx, child_row in enumerate(rows, start=1):
+                for header, value in child_row.items():
+                    if str(header).startswith("#"):
+                        continue
+                    row[
+                        COLUMN_X2M_SEPARATOR.join([field_name, str(idx), header])
+                    ] = value
+        return row
+
+    def _jsonify_with_limits(self, records, parser, limits):
+        """
+        jsonify the records but only read and serialize the related records
+        of x2many fields that will be exported, according to the number of
+        occurence of the pattern lines. The related records are kept in the
+        order of the field.
+        @param records: recordset
+        @param parser: jsonify parser
+        @param limits: dict returned by _get_x2many_limits_for_pattern
+        @return: list of dict
+        """
+        if not limits:
+            return records.jsonify(parser)
+        simple_parser = []
+        limited_parser = []
+        for field in parser:
+            if isinstance(field, tuple) and field[0] in limits:
+                limited_parser.append(field)
+            else:
+                simple_parser.append(field)
+        result = records.jsonify(simple_parser)
+        for field_name, subparser in limited_parser:
+            node = limits[field_name]
+            related_ids = []
+            for record in records:
+                ids = record[field_name].ids
+                if node["limit"] is not None:
+                    ids = ids[: node["limit"]]
+                related_ids.append(ids)
+            all_ids = list(dict.fromkeys(id_ for ids in related_ids for id_ in ids))
+            # browse from a new environment model to only prefetch
+            # the related records that are exported
+            comodel = records.env[records._fields[field_name].comodel_name]
+            related_data = dict(
+                zip(
+                    all_ids,
+                    self._jsonify_with_limits(
+                        comodel.browse(all_ids), subparser, node["fields"]
+                    ),
+                )
+            )
+            for data, ids in zip(result, related_ids):
+                if node["limit"] is not None:
+                    data[field_name] = [related_data[id_] for id_ in ids]
+                elif ids:
+                    data[field_name] = related_data[ids[0]]
+                else:
+                    data[field_name] = None
+        return result
+
+    def _is_flat_field(self, field):
+        return field.name == "id" or (field.store and field.type in SCALAR_FIELD_TYPES)
+
+    def _get_flat_fields(self):
+        """
+        Check if the pattern is only made of stored scalar fields and
+        many2one with a scalar subfield, such pattern can be exported
+        without jsonify
+        @return: list of tuple (header, field name, subfield name or None)
+        or None if the pattern doesn't qualify
+        """
+        self.ensure_one()
+        if self.env.context.get("pattern_export_no_flat") or not self.export_fields:
+            return None
+        model = self.env[self.resource]
+        result = []
+        for line in self.export_fields:
+            names = (line.name or "").split("/")
+            field = model._fields.get(names[0])
+            if not field or line.pattern_export_id:
+                return None
+            header = line._get_header()
+            if len(names) == 1 and self._is_flat_field(field):
+                result.append((header[0], names[0], None))
+            elif len(names) == 2 and field.type == "many2one" and field.store:
+                subfield = self.env[field.comodel_name]._fields.get(names[1])
+                if not subfield or not (
+                    subfield.name == "id" or subfield.type in SCALAR_FIELD_TYPES
+                ):
+                    return None
+                result.append((header[0], names[0], names[1]))
+            else:
+                return None
+        return result
+
+    def _jsonify_value(self, field, value, record):
+        """Format the value exactly as jsonify does"""
+        if value is False and field.type != "boolean":
+            return None
+        elif field.type == "date":
+            return fields.Date.to_date(value).isoformat()
+        elif field.type == "datetime":
+            value = fields.Datetime.to_datetime(value)
+            return fields.Datetime.context_timestamp(record, value).isoformat()
+        return value
+
+    def _read_flat_values(self, records, fnames):
+        """
+        @return: dict with the values read indexed by record id
+        """
+        if not fnames:
+            # read without field name return all the fields
+            return {record_id: {"id": record_id} for record_id in records.ids}
+        return {
+            vals["id"]: vals for vals in records.read(fnames, load="_classic_write")
+        }
+
+    def _get_flat_data_to_export(self, chunks, flat_fields):
+        """
+        Export a flat pattern by reading only the exported columns
+        in batch and resolving the many2one subfields with one read
+        per chunk instead of serializing each record
+        """
+        model = self.env[self.resource]
+        fnames = list({fname for __, fname, __ in flat_fields if fname != "id"})
+        subfnames = {}
+        for __, fname, subfname in flat_fields:
+            if subfname:
+                subfnames.setdefault(fname, set()).add(subfname)
+        export_id = any(fname == "id" for __, fname, __ in flat_fields)
+        for chunk in chunks:
+            ids = chunk.ids
+            xmlids = self._get_export_xmlids(chunk) if export_id else {}
+            values = self._read_flat_values(chunk, fnames)
+            subvalues = {}
+            for fname, subfields in subfnames.items():
+                comodel = self.env[model._fields[fname].comodel_name]
+                comodel_ids = list({vals[fname] for vals in values.values()} - {False})
+                subvalues[fname] = self._read_flat_values(
+                    comodel.browse(comodel_ids), list(subfields - {"id"})
+                )
+            for record_id in ids:
+                vals = values[record_id]
+                row = {}
+                for header, fname, subfname in flat_fields:
+                    if fname == "id":
+                        row[header] = xmlids.get(record_id, record_id)
+                    elif not subfname:
+                        row[header] = self._jsonify_value(
+                            model._fields[fname], vals[fname], chunk
+                        )
+                    elif not vals[fname]:
+                        row[header] = None
+                    else:
+                        comodel = self.env[model._fields[fname].comodel_name]
+                        row[header] = self._jsonify_value(
+                            comodel._fields[subfname],
+                            subvalues[fname][vals[fname]][subfname],
+                            chunk,
+                        )
+                yield row
 
-    def json2flatty(self, data):
+    def json2flatty(self, data, headers=None):
         res = {}
-        for header in self._get_header():
+        if headers is None:
+            headers = self._get_header()
+        for header in headers:
             try:
                 val = data
                 for key in header.split(COLUMN_X2M_SEPARATOR):
@@ -155,9 +718,116 @@ class IrExports(models.Model):
         """
         self.ensure_one()
         record.ensure_one()
-        data = record.jsonify(parser)[0]
+        limits = self.export_fields._get_x2many_limits_for_pattern()
+        data = self._jsonify_with_limits(record, parser, limits)[0]
         return self.json2flatty(data)
 
+    @api.multi
+    def _get_export_metadata(self):
+        """
+        Collect the information needed by the format writers in addition
+        to the rows, so the writers don't have to use the ORM
+        @return: dict
+        """
+        self.ensure_one()
+        return {
+            "name": self.name,
+            "headers": self._get_header(),
+            "description_headers": self.use_description
+            and self._get_header(use_description=True)
+            or [],
+            "row_start_records": self.row_start_records,
+            "sheets": self._get_o2m_sheets_metadata(),
+        }
+
+    @api.multi
+    def _write_export_file(self, records, sink, governor=None, domain=None):
+        """
+        Write the export of the given recordset into the sink.
+        The format writer _export_rows_<format>(sink, metadata, rows)
+        receives an iterator of flattened rows and write them progressively
+        so the whole file is never kept in memory.
+        Formats only implementing _export_with_record_<format> (returning the
+        content of the file) are still supported.
+        @param records: recordset
+        @param sink: writable binary file object
+        @param governor: MemoryGovernor used to export the records
+        @param domain: export the records matching the domain instead
+        of the given records
+        """
+        self.ensure_one()
+        writer = "_export_rows_{format}".format(format=self.export_format or "")
+        legacy_writer = "_export_with_record_{format}".format(
+            format=self.export_format or ""
+        )
+        if self.export_format and hasattr(self, writer):
+            metadata = self._get_export_metadata()
+            rows = self._get_data_to_export(records, governor=governor, domain=domain)
+            if self.pipelined_export:
+                self._write_rows_in_thread(getattr(self, writer), sink, metadata, rows)
+            else:
+                getattr(self, writer)(sink, metadata, rows)
+        elif self.export_format and hasattr(self, legacy_writer):
+            if domain is not None:
+                records = self.env[self.resource].search(domain)
+            sink.write(getattr(self, legacy_writer)(records) or b"")
+        else:
+            msg = "The export with the format {format} doesn't exist!".format(
+                format=self.export_format or "Undefined"
+            )
+            raise NotImplementedError(msg)
+
+    def _write_rows_in_thread(self, writer, sink, metadata, rows):
+        """
+        Run the format writer in a separate thread, fed with the rows through
+        a bounded queue, so the serialization and the compression of the file
+        overlap with the reading of the records. The environment is not
+        thread safe: the writer only gets the metadata and the rows.
+        @param writer: method _export_rows_<format>
+        @param sink: writable binary file object
+        @param metadata: dict returned by _get_export_metadata
+        @param rows: iterator of dict
+        """
+        queue_size = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("pattern_import_export.export_queue_size", 1000)
+        )
+        row_queue = queue.Queue(maxsize=queue_size)
+        errors = []
+
+        def queued_rows():
+            for row in iter(row_queue.get, END_OF_ROWS):
+                yield row
+
+        def write():
+            try:
+                writer(sink, metadata, queued_rows())
+            except Exception as e:
+                errors.append(e)
+
+        def put(item):
+            # stop sending the rows if the writer failed
+            while thread.is_alive():
+                try:
+                    row_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        thread = threading.Thread(target=write, name="pattern_export_writer")
+        thread.start()
+        try:
+            for row in rows:
+                if not put(row):
+                    break
+        finally:
+            put(END_OF_ROWS)
+            thread.join()
+        if errors:
+            raise errors[0]
+
     @api.multi
     def _generate_with_records(self, records):
         """
@@ -167,54 +837,223 @@ class IrExports(models.Model):
         """
         all_data = []
         for export in self:
-            target_function = "_export_with_record_{format}".format(
-                format=export.export_format or ""
-            )
-            if not export.export_format or not hasattr(export, target_function):
-                msg = "The export with the format {format} doesn't exist!".format(
-                    format=export.export_format or "Undefined"
-                )
-                raise NotImplementedError(msg)
-            export_data = getattr(export, target_function)(records)
-            if export_data:
-                all_data.append(base64.b64encode(export_data))
+            export_file = BytesIO()
+            export._write_export_file(records, export_file)
+            if export_file.tell():
+                all_data.append(base64.b64encode(export_file.getvalue()))
         return all_data
 
     @api.multi
-    def _export_with_record(self, records):
+    def _export_with_record(self, records, domain=None):
         """
         Export given recordset
         @param records: recordset
+        @param domain: export the records matching the domain instead
+        of the given records
         @return: ir.attachment recordset
         """
         patterned_exports = self.env["patterned.import.export"]
-        all_data = self._generate_with_records(records)
-        if all_data and self.env.context.get("export_as_attachment", True):
-            for export, attachment_data in zip(self, all_data):
-                patterned_exports |= export._create_patterned_export(attachment_data)
+        as_attachment = self.env.context.get("export_as_attachment", True)
+        for export in self:
+            cache_key = False
+            if export.use_export_cache and as_attachment:
+                cache_key = export._get_export_cache_key(records, domain=domain)
+                cached_export = export._get_cached_export(cache_key)
+                if cached_export:
+                    patterned_exports |= cached_export
+                    continue
+            governor = MemoryGovernor(self.env)
+            with tempfile.TemporaryFile() as export_file:
+                export._write_export_file(
+                    records, export_file, governor=governor, domain=domain
+                )
+                if export_file.tell() and as_attachment:
+                    patterned_export = export._create_patterned_export(export_file)
+                    patterned_export.write(
+                        {
+                            "cache_key": cache_key,
+                            "memory_profile": governor.get_profile(),
+                        }
+                    )
+                    patterned_exports |= patterned_export
         return patterned_exports
 
+    @job(default_channel="root.exportwithpattern")
+    def _generate_export_with_domain_job(self, domain):
+        """
+        Export the records matching the domain: only the domain is stored
+        in the job and the records are searched by chunks
+        """
+        export = self._export_with_record(self.env[self.resource].browse(), domain)
+        return self._notify_export_result(export)
+
+    @api.multi
+    def _get_export_cache_key(self, records, domain=None):
+        """
+        Build the key of the export of the records: it changes when the
+        pattern, the exported records (and their order) or any record read by
+        the pattern is modified
+        @param records: recordset
+        @param domain: build the key of the records matching the domain
+        instead, searched by chunks like the export
+        @return: str
+        """
+        self.ensure_one()
+        digest = hashlib.sha1()
+        self._update_pattern_digest(digest)
+        if domain is None:
+            self._update_data_digest(digest, records)
+        else:
+            governor = MemoryGovernor(self.env)
+            for chunk in self._search_record_chunks(domain, governor):
+                self._update_data_digest(digest, chunk)
+        user = self.env.user
+        # the exported values depends on the access rights, the language
+        # and the timezone of the user
+        digest.update(
+            str(
+                (
+                    user.groups_id.ids,
+                    user.company_id.id,
+                    self.env.lang,
+                    self.env.context.get("tz") or user.tz,
+                )
+            ).encode()
+        )
+        return digest.hexdigest()
+
+    @api.multi
+    def _update_pattern_digest(self, digest, visited=None):
+        if visited is None:
+            visited = set()
+        for rec in self:
+            if rec.id in visited:
+                continue
+            visited.add(rec.id)
+            digest.update(str((rec.id, rec.write_date)).encode())
+            for line in rec.export_fields:
+                digest.update(str((line.id, line.write_date)).encode())
+            rec.export_fields.mapped("pattern_export_id")._update_pattern_digest(
+                digest, visited
+            )
+
+    @api.multi
+    def _update_data_digest(self, digest, records):
+        """
+        Add the exported records and the related records reached by the lines
+        of the pattern and its sub-patterns to the digest
+        """
+        self.ensure_one()
+        self._update_records_digest(digest, records)
+        for line in self.export_fields:
+            related = records
+            for field_name in line.name.split("/"):
+                field = related._fields.get(field_name)
+                if not field or not field.relational:
+                    break
+                related = self._read_related_records(related, field_name)
+                self._update_records_digest(digest, related)
+            if line.pattern_export_id and related is not records:
+                line.pattern_export_id._update_data_digest(digest, related)
+
+    def _read_related_records(self, records, field_name):
+        """Only read the relational column instead of prefetching the records"""
+        related_ids = set()
+        for ids in split_every(models.PREFETCH_MAX, records.ids):
+            for vals in records.browse(ids).read([field_name], load="_classic_write"):
+                value = vals[field_name]
+                if isinstance(value, list):
+                    related_ids.update(value)
+                elif value:
+                    related_ids.add(value)
+        comodel_name = records._fields[field_name].comodel_name
+        return self.env[comodel_name].browse(sorted(related_ids))
+
+    def _update_records_digest(self, digest, records):
+        """
+        Add the ids and the last write date of the records, and of their
+        _inherits parents, to the digest
+        """
+        cr = self.env.cr
+        digest.update(records._name.encode())
+        parent_ids = {
+            parent_field: set() for parent_field in records._inherits.values()
+        }
+        for ids in split_every(models.PREFETCH_MAX, records.ids):
+            digest.update(str(ids).encode())
+            if records._log_access:
+                cr.execute(
+                    'SELECT max(write_date) FROM "{}" WHERE id IN %s'.format(
+                        records._table
+                    ),
+                    (ids,),
+                )
+                digest.update(str(cr.fetchone()[0]).encode())
+            for parent_field in parent_ids:
+                cr.execute(
+                    'SELECT DISTINCT "{}" FROM "{}" WHERE id IN %s'.format(
+                        parent_field, records._table
+                    ),
+                    (ids,),
+                )
+                parent_ids[parent_field].update(row[0] for row in cr.fetchall())
+        for parent_model, parent_field in records._inherits.items():
+            self._update_records_digest(
+                digest, self.env[parent_model].browse(sorted(parent_ids[parent_field]))
+            )
+
+    @api.multi
+    def _get_cached_export(self, cache_key):
+        """
+        @return: the last valid export with the same cache key
+        """
+        self.ensure_one()
+        patterned_export = self.env["patterned.import.export"].search(
+            [
+                ("export_id", "=", self.id),
+                ("kind", "=", "export"),
+                ("status", "=", "success"),
+                ("cache_key", "=", cache_key),
+                (
+                    "create_date",
+                    ">=",
+                    self.env["patterned.import.export"]._get_export_cache_limit_date(),
+                ),
+            ],
+            order="id desc",
+            limit=1,
+        )
+        # the write dates of the current transaction are all the same so an
+        # export done in this transaction may be outdated with the same key
+        self.env.cr.execute("SELECT now() at time zone 'UTC'")
+        if patterned_export.create_date == self.env.cr.fetchone()[0]:
+            return patterned_export.browse()
+        return patterned_export
+
     def _create_patterned_export(self, attachment_datas):
         """
-        Attach given parameter (b64 encoded) to the current export.
-        @param attachment_datas: base64 encoded data
+        Attach given parameter to the current export.
+        @param attachment_datas: base64 encoded data or binary file object
         @return: ir.attachment recordset
         """
         self.ensure_one()
         name = "{name}.{format}".format(name=self.name, format=self.export_format)
-        return self.env["patterned.import.export"].create(
-            {
-                "name": name,
-                "type": "binary",
-                "res_id": self.id,
-                "res_model": "ir.exports",
-                "datas": attachment_datas,
-                "datas_fname": name,
-                "kind": "export",
-                "status": "success",
-                "export_id": self.id,
-            }
-        )
+        vals = {
+            "name": name,
+            "type": "binary",
+            "res_id": self.id,
+            "res_model": "ir.exports",
+            "datas_fname": name,
+            "kind": "export",
+            "status": "success",
+            "export_id": self.id,
+        }
+        if hasattr(attachment_datas, "read"):
+            patterned_export = self.env["patterned.import.export"].create(vals)
+            patterned_export.attachment_id._set_datas_from_file(attachment_datas)
+            return patterned_export
+        vals["datas"] = attachment_datas
+        return self.env["patterned.import.export"].create(vals)
 
     # Import part
 
@@ -232,6 +1071,74 @@ class IrExports(models.Model):
             raise NotImplementedError()
         return getattr(self, target_function)(datafile)
 
+    def _get_row_key(self, row):
+        """
+        Build the key identifying the record of a row from its id, .id and
+        key columns
+        @param row: dict
+        @return: str or None if the row doesn't have any key
+        """
+        key = []
+        for header in sorted(row, key=str):
+            field_name = str(header).split(COLUMN_X2M_SEPARATOR, 1)[0]
+            if field_name in ("id", ".id") or field_name.endswith(IDENTIFIER_SUFFIX):
+                if row[header] not in (None, ""):
+                    key.append((header, row[header]))
+        if not key:
+            return None
+        return json.dumps(key, default=str)
+
+    def _get_row_hash(self, row):
+        content = [
+            (str(header), value)
+            for header, value in row.items()
+            if not str(header).startswith("#")
+        ]
+        content.sort(key=lambda item: item[0])
+        return hashlib.sha1(json.dumps(content, default=str).encode()).hexdigest()
+
+    def _get_known_row_hashes(self):
+        self.env.cr.execute(
+            "SELECT key, row_hash FROM patterned_import_row_hash WHERE export_id = %s",
+            (self.id,),
+        )
+        return dict(self.env.cr.fetchall())
+
+    def _filter_unchanged_rows(self, datas, stats):
+        """
+        Replace the rows identical to the last successful import by an
+        empty row. Empty rows are ignored by the import but are kept
+        to not shift the line numbers of the messages.
+        @param datas: iterator of dict
+        @param stats: dict filled with the number of skipped rows
+        and the hashes of the processed rows
+        @return: iterator of dict
+        """
+        known_hashes = self._get_known_row_hashes()
+        for row in datas:
+            key = self._get_row_key(row)
+            if key:
+                row_hash = self._get_row_hash(row)
+                if known_hashes.get(key) == row_hash:
+                    stats["skipped"] += 1
+                    yield {}
+                    continue
+                stats["hashes"][key] = row_hash
+            yield row
+
+    def _save_row_hashes(self, row_hashes):
+        cr = self.env.cr
+        for chunk in split_every(1000, row_hashes.items()):
+            values = ",".join(
+                cr.mogrify("(%s, %s, %s)", (self.id, key, row_hash)).decode("utf-8")
+                for key, row_hash in chunk
+            )
+            cr.execute(
+                "INSERT INTO patterned_import_row_hash (export_id, key, row_hash) "
+                "VALUES {} ON CONFLICT (export_id, key) "
+                "DO UPDATE SET row_hash = EXCLUDED.row_hash".format(values)
+            )
+
     def _process_load_message(self, messages):
         count_errors = 0
         count_warnings = 0
@@ -273,26 +1180,1024 @@ class IrExports(models.Model):
             status = "success"
         return info, info_detail, status
 
+    def _get_duplicated_key_messages(self, rows):
+        """
+        @param rows: list of tuple (row number, row)
+        @return: list of messages for the rows using the key of a previous row
+        """
+        messages = []
+        first_row_by_key = {}
+        for row_number, row in rows:
+            key = self._get_row_key(row)
+            if not key:
+                continue
+            if key in first_row_by_key:
+                messages.append(
+                    {
+                        "type": "error",
+                        "rows": {"from": row_number, "to": row_number},
+                        "message": _("The key is already used on the line {}").format(
+                            first_row_by_key[key]
+                        ),
+                    }
+                )
+            else:
+                first_row_by_key[key] = row_number
+        return messages
+
+    def _validate_import_rows(self, rows):
+        return (
+            self.env[self.model_id.model]
+            .with_context(
+                load_format="flatty", pattern_import_export_model=self.model_id.model
+            )
+            ._validate_flatty_rows(rows)
+        )
+
+    def _validate_import_rows_in_thread(self, rows):
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            try:
+                env = api.Environment(cr, self.env.uid, self.env.context)
+                return self.with_env(env)._validate_import_rows(rows)
+            finally:
+                cr.rollback()
+
+    def _dry_run_import(self, datas):
+        """
+        Validate the rows to import without writing anything. The rows are
+        converted by the same code as the import so the messages are the
+        same. Big files are validated by chunks in parallel, each thread
+        using its own cursor.
+        @param datas: iterator of dict
+        @return: dict with the same format as the result of load
+        """
+        rows = list(enumerate(datas, start=1))
+        messages = self._get_duplicated_key_messages(rows)
+        chunks = list(split_every(DRY_RUN_CHUNK_SIZE, rows, list))
+        workers = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("pattern_import_export.dry_run_workers", 4)
+        )
+        if len(chunks) > 1 and workers > 1 and not self.env.registry.in_test_mode():
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for chunk_messages in executor.map(
+                    self._validate_import_rows_in_thread, chunks
+                ):
+                    messages.extend(chunk_messages)
+        else:
+            for chunk in chunks:
+                messages.extend(self._validate_import_rows(chunk))
+        messages.sort(key=lambda message: message["rows"]["to"])
+        return {"ids": [], "messages": messages}
+
+    def _run_import(self, patterned_import, datas, stats):
+        """
+        Import (or only validate) the rows
+        @param datas: iterator of dict
+        @param stats: dict filled with the number of skipped rows
+        @return: dict, result of load
+        """
+        if self.skip_unchanged_rows:
+            datas = self._filter_unchanged_rows(datas, stats)
+        if patterned_import.dry_run:
+            return self._dry_run_import(datas)
+        if self.stage_import_rows and self.import_job_count <= 1:
+            if not patterned_import.staged_row_ids:
+                self._stage_import_rows(patterned_import, datas)
+            res = self._import_staged_rows(patterned_import)
+        elif self.resumable_import and self.import_job_count <= 1:
+            res = self._load_by_committed_chunks(patterned_import, datas)
+        else:
+            res = self._load_by_chunks(datas)
+        return res
+
+    def _save_import_row_hashes(self, patterned_import, res, row_hashes):
+        """
+        Remember the content of the imported rows, only when the whole
+        file was imported without message
+        """
+        if (
+            self.skip_unchanged_rows
+            and not patterned_import.dry_run
+            and not res.get("messages")
+        ):
+            self._save_row_hashes(row_hashes)
+
+    def _get_import_model(self):
+        model = self.env[self.model_id.model].with_context(
+            load_format="flatty", pattern_import_export_model=self.model_id.model
+        )
+        if self.bulk_import:
+            model = model.with_context(
+                tracking_disable=True,
+                mail_notrack=True,
+                mail_create_nolog=True,
+                recompute=False,
+            )
+        return model
+
+    def _load_chunk(self, model, rows, row_offset):
+        """
+        Load a chunk of rows
+        @param row_offset: number of the rows of the file before the chunk
+        @return: dict, result of load, with "recompute_failed" set if the
+        stored computed fields of a bulk import can not be computed
+        """
+        if self.raw_create:
+            chunk_res = self._raw_create(rows, row_offset=row_offset)
+        else:
+            # the external ids of the chunk are resolved at once
+            # and kept for the whole chunk by the converter, the values of
+            # the rows are kept to only flush the pending records (and
+            # break the creation in batch) when a row may reference them
+            chunk_res = model.with_context(
+                pattern_import_row_offset=row_offset,
+                pattern_import_xmlids={},
+                pattern_import_pending_values=set(),
+            ).load([], rows)
+        if self.bulk_import:
+            if any(message["type"] == "error" for message in chunk_res["messages"]):
+                # nothing is kept, no need to compute the fields
+                self.env.clear()
+            else:
+                error = self._recompute_import_chunk(model)
+                if error:
+                    chunk_res["messages"].append(
+                        {
+                            "type": "error",
+                            "message": error,
+                            "rows": {
+                                "from": row_offset + 1,
+                                "to": row_offset + len(rows),
+                            },
+                        }
+                    )
+                    chunk_res["recompute_failed"] = True
+        return chunk_res
+
+    def _load_by_chunks(self, datas):
+        """
+        Load the rows by chunks, clearing the cache between two chunks.
+        As with a single load, nothing is kept if there is an error.
+        @return: dict, merged results of load
+        """
+        model = self._get_import_model()
+        governor = MemoryGovernor(self.env)
+        res = {"ids": [], "messages": []}
+        cr = self.env.cr
+        cr.execute("SAVEPOINT pattern_import_load")
+        row_offset = 0
+        for rows in governor.split(datas):
+            chunk_res = self._load_chunk(model, rows, row_offset)
+            res["ids"] += chunk_res["ids"] or []
+            res["messages"] += chunk_res["messages"]
+            if chunk_res.get("recompute_failed"):
+                break
+            row_offset += len(rows)
+        if any(message["type"] == "error" for message in res["messages"]):
+            cr.execute("ROLLBACK TO SAVEPOINT pattern_import_load")
+            res["ids"] = False
+            self.pool.reset_changes()
+            self.env.invalidate_all()
+        cr.execute("RELEASE SAVEPOINT pattern_import_load")
+        res["memory_profile"] = governor.get_profile()
+        return res
+
+    def _load_by_committed_chunks(self, patterned_import, datas):
+        """
+        Load the rows by chunks, each chunk is committed with a checkpoint
+        saved on the import so a restarted job resumes after the last
+        committed chunk. Only the chunks with errors are not kept.
+        @return: dict, merged results of load
+        """
+        model = self._get_import_model()
+        governor = MemoryGovernor(self.env)
+        row_offset = patterned_import.checkpoint_row
+        res = {"ids": [], "messages": []}
+        for checkpoint in patterned_import.checkpoint_chunk_ids:
+            res["ids"] += json.loads(checkpoint.record_ids or "[]")
+            res["messages"] += json.loads(checkpoint.messages or "[]")
+        cr = self.env.cr
+        for rows in governor.split(itertools.islice(datas, row_offset, None)):
+            cr.execute("SAVEPOINT pattern_import_chunk")
+            chunk_res = self._load_chunk(model, rows, row_offset)
+            chunk_ids = []
+            if any(message["type"] == "error" for message in chunk_res["messages"]):
+                cr.execute("ROLLBACK TO SAVEPOINT pattern_import_chunk")
+                self.pool.reset_changes()
+                self.env.invalidate_all()
+            else:
+                chunk_ids = chunk_res["ids"] or []
+            cr.execute("RELEASE SAVEPOINT pattern_import_chunk")
+            res["ids"] += chunk_ids
+            res["messages"] += chunk_res["messages"]
+            row_offset += len(rows)
+            # only the result of the chunk is saved, not the whole result
+            self.env["patterned.import.checkpoint"].sudo().create(
+                {
+                    "patterned_import_id": patterned_import.id,
+                    "row_offset": row_offset,
+                    "record_ids": json.dumps(chunk_ids),
+                    "messages": json.dumps(chunk_res["messages"], default=str),
+                }
+            )
+            patterned_import.checkpoint_row = row_offset
+            self._commit_import_chunk()
+        res["memory_profile"] = governor.get_profile()
+        return res
+
+    def _stage_import_rows(self, patterned_import, datas, partitioned=False):
+        """
+        Store the rows of the file, one row per line, the empty rows are
+        skipped
+        @param datas: iterator of dict
+        @param partitioned: store the partition of the rows, for the imports
+        split in several jobs
+        """
+        rows = (
+            (row_number, row) for row_number, row in enumerate(datas, start=1) if row
+        )
+        for chunk in split_every(STAGING_CHUNK_SIZE, rows):
+            if partitioned:
+                partitions = self._get_row_partitions(chunk)
+            else:
+                partitions = [None] * len(chunk)
+            values = [
+                (
+                    patterned_import.id,
+                    row_number,
+                    json.dumps(row, default=str),
+                    "pending",
+                    partition,
+                )
+                for (row_number, row), partition in zip(chunk, partitions)
+            ]
+            self.env.cr.execute(
+                "INSERT INTO patterned_import_row "
+                "(patterned_import_id, row_number, data, status, partition) "
+                "VALUES {}".format(", ".join(["%s"] * len(values))),
+                values,
+            )
+        patterned_import.invalidate_cache(["staged_row_ids"])
+
+    def _import_staged_rows(self, patterned_import):
+        """
+        Import by chunks the staged rows which are not imported yet. The
+        chunks with errors are rolled back: their rows with an error fail,
+        the others stay pending.
+        @return: dict, merged results of load
+        """
+        model = self._get_import_model()
+        governor = MemoryGovernor(self.env)
+        res = {"ids": [], "messages": []}
+        cr = self.env.cr
+        staged_ids = (
+            self.env["patterned.import.row"]
+            .search(
+                [
+                    ("patterned_import_id", "=", patterned_import.id),
+                    ("status", "!=", "success"),
+                ]
+            )
+            .ids
+        )
+        for ids in governor.split(staged_ids):
+            staged_rows = self.env["patterned.import.row"].browse(ids)
+            row_numbers = staged_rows.mapped("row_number")
+            cr.execute("SAVEPOINT pattern_import_staged")
+            chunk_res = self._load_chunk(
+                model, [json.loads(data) for data in staged_rows.mapped("data")], 0
+            )
+            # the messages refer to the position of the row in the chunk
+            messages = [
+                self._get_staged_message(message, row_numbers)
+                for message in chunk_res["messages"]
+            ]
+            failed = any(message["type"] == "error" for message in messages)
+            if failed:
+                cr.execute("ROLLBACK TO SAVEPOINT pattern_import_staged")
+                self.pool.reset_changes()
+                self.env.invalidate_all()
+            else:
+                res["ids"] += chunk_res["ids"] or []
+            cr.execute("RELEASE SAVEPOINT pattern_import_staged")
+            res["messages"] += messages
+            self._update_staged_rows(staged_rows, messages, failed)
+        res["memory_profile"] = governor.get_profile()
+        return res
+
+    def _get_staged_message(self, message, row_numbers):
+        def get_row_number(position):
+            if position and 0 < position <= len(row_numbers):
+                return row_numbers[position - 1]
+            return position
+
+        rows = message.get("rows") or {}
+        return dict(
+            message, rows={key: get_row_number(value) for key, value in rows.items()}
+        )
+
+    def _update_staged_rows(self, staged_rows, messages, failed):
+        messages_by_row = defaultdict(list)
+        for message in messages:
+            messages_by_row[message["rows"].get("to")].append(message)
+        staged_rows.write(
+            {"status": "pending" if failed else "success", "messages": False}
+        )
+        for staged_row in staged_rows:
+            row_messages = messages_by_row.get(staged_row.row_number)
+            if not row_messages:
+                continue
+            vals = {"messages": json.dumps(row_messages, default=str)}
+            if any(message["type"] == "error" for message in row_messages):
+                vals["status"] = "fail"
+            staged_row.write(vals)
+
+    @api.multi
+    def _patch_staged_rows(self, patterned_import, datas):
+        """
+        Replace the staged rows of an import which are not imported yet by
+        the rows of a patch file, identified by their line in the imported
+        file (#line column) or else by their key
+        @param datas: iterator of dict
+        """
+        self.ensure_one()
+        staged_rows = self.env["patterned.import.row"].search(
+            [
+                ("patterned_import_id", "=", patterned_import.id),
+                ("status", "!=", "success"),
+            ]
+        )
+        by_number = {staged_row.row_number: staged_row for staged_row in staged_rows}
+        by_key = {}
+        for staged_row in staged_rows:
+            key = self._get_row_key(json.loads(staged_row.data))
+            if key:
+                by_key[key] = staged_row
+        for row in datas:
+            if not row:
+                continue
+            row_number = row.pop(STAGED_ROW_NUMBER, None)
+            if row_number:
+                staged_row = by_number.get(int(row_number))
+            else:
+                staged_row = by_key.get(self._get_row_key(row))
+            if not staged_row:
+                raise UserError(
+                    _("No row to import again found for the row {}").format(row)
+                )
+            staged_row.write(
+                {"data": json.dumps(row, default=str), "status": "pending"}
+            )
+
     @job(default_channel="root.importwithpattern")
-    def _generate_import_with_pattern_job(self, patterned_import):
+    def _retry_staged_import_job(self, patterned_import):
+        res = self._import_staged_rows(patterned_import)
+        self._set_import_result(
+            patterned_import, res, patterned_import.count_skipped_rows
+        )
+        return self._notify_user(patterned_import)
+
+    def _commit_import_chunk(self):
+        # the tests run in one transaction which can not be committed
+        if not getattr(threading.currentThread(), "testing", False):
+            self.env.cr.commit()
+
+    @api.constrains("raw_create", "resource", "export_fields")
+    def _check_raw_create(self):
+        for record in self:
+            if record.raw_create:
+                error = record._get_raw_create_error()
+                if error:
+                    raise ValidationError(error)
+
+    @api.multi
+    def _get_raw_create_error(self):
+        """
+        Check if the records of the pattern can be created directly in the
+        database: the model must not have any logic on create and the
+        pattern must only contain stored fields which are not computed
+        or translated and many2one with a subfield
+        @return: the reason why the pattern doesn't qualify or None
+        """
+        self.ensure_one()
+        model = self.env[self.resource]
+        if (
+            model._abstract
+            or model._transient
+            or not model._auto
+            or model._inherits
+            or model._parent_store
+        ):
+            return _("The records of {} can not be created in raw mode").format(
+                model._name
+            )
+        for cls in type(model).mro():
+            if "create" in vars(cls) and cls.__module__ != models.BaseModel.__module__:
+                return _(
+                    "The records of {} can not be created in raw mode, "
+                    "the model has some logic on create ({})"
+                ).format(model._name, cls.__module__)
+        flat_fields = self._get_flat_fields()
+        if not flat_fields:
+            return _(
+                "Only the patterns of scalar fields and many2one "
+                "can create the records in raw mode"
+            )
+        for __, fname, __ in flat_fields:
+            field = model._fields[fname]
+            if fname == "id":
+                continue
+            if field.compute or field.translate or fname in models.MAGIC_COLUMNS:
+                return _(
+                    "The field {} can not be imported in raw mode: computed, "
+                    "translated and magic fields are not supported"
+                ).format(fname)
+        return None
+
+    def _raw_create(self, rows, row_offset=0):
+        """
+        Create the records of the rows directly in the database: the
+        references of the whole chunk are searched at once, the values are
+        converted and checked in python then all the rows are inserted with
+        COPY. The stored computed fields and the constraints are computed
+        and checked after the insert.
+        @param rows: list of dict
+        @param row_offset: number of the rows of the file before the chunk
+        @return: dict, same result as load
+        """
+        model = self.env[self.resource]
+
+        def chunk_error(message):
+            return {
+                "ids": False,
+                "messages": [
+                    {
+                        "type": "error",
+                        "message": message,
+                        "rows": {"from": row_offset + 1, "to": row_offset + len(rows)},
+                    }
+                ],
+            }
+
+        # the lines of the pattern or the model may have changed
+        error = self._get_raw_create_error()
+        if error:
+            return chunk_error(error)
+        if not model.check_access_rights("create", raise_exception=False):
+            return chunk_error(
+                _("You are not allowed to create the records of {}").format(model._name)
+            )
+        items = []
+        for idx, row in enumerate(rows, start=row_offset + 1):
+            model._remove_commented_columns(row)
+            if any(row.values()):
+                items.append((idx, row))
+        messages = []
+        errors = set()
+
+        def log(idx, message):
+            messages.append(
+                {"type": "error", "message": message, "rows": {"from": idx, "to": idx}}
+            )
+            errors.add(idx)
+
+        flat_fields = self._get_flat_fields()
+        self._check_raw_create_new_records(model, items, flat_fields, log)
+        references = self._get_raw_create_references(model, items, flat_fields)
+        converters = {
+            fname: self.env["ir.fields.converter"].to_field(model, model._fields[fname])
+            for __, fname, subfname in flat_fields
+            if fname != "id" and not subfname
+        }
+        column_fnames = [
+            fname
+            for fname, field in model._fields.items()
+            if field.store
+            and field.column_type
+            and fname not in models.MAGIC_COLUMNS
+            and not field.compute
+        ]
+        defaults = model.default_get(
+            [fname for fname in column_fnames if fname not in converters]
+        )
+        # the defaults of the fields can be different for each record
+        # (sequence...), only the defaults of the context and the user
+        # defaults are the same for all the records
+        ir_defaults = self.env["ir.default"].get_model_defaults(model._name)
+        row_default_fields = [
+            model._fields[fname]
+            for fname in defaults
+            if model._fields[fname].default
+            and fname not in ir_defaults
+            and "default_" + fname not in self._context
+        ]
+        records_values = [
+            self._get_raw_create_values(
+                model,
+                row,
+                dict(
+                    defaults,
+                    **{
+                        field.name: self._get_raw_create_default(model, field)
+                        for field in row_default_fields
+                    }
+                ),
+                flat_fields,
+                references,
+                converters,
+                lambda message: log(idx, message),
+            )
+            for idx, row in items
+        ]
+        if errors:
+            return {"ids": False, "messages": messages}
         try:
-            attachment_data = base64.b64decode(patterned_import.datas.decode("utf-8"))
-            datas = self._read_import_data(attachment_data)
+            with self.env.cr.savepoint():
+                ids = self._raw_insert(model, column_fnames, records_values)
+                xmlids = {
+                    res_id: row["id"] if "." in row["id"] else "__import__." + row["id"]
+                    for res_id, (__, row) in zip(ids, items)
+                    if isinstance(row.get("id"), str) and row["id"]
+                }
+                self._create_xmlids(model._name, xmlids)
+                records = model.browse(ids)
+                records.check_access_rule("create")
+                for field in model._fields.values():
+                    if field.compute and field.store:
+                        self.env.add_todo(field, records)
+                records.modified(column_fnames)
+                model.recompute()
+                records._validate_fields(column_fnames)
         except Exception as e:
-            patterned_import.status = "fail"
-            patterned_import.info = _("Failed (check details)")
-            patterned_import.info_detail = e
-        res = (
-            self.with_context(
-                load_format="flatty", pattern_import_export_model=self.model_id.model
+            self.env.clear()
+            return chunk_error(str(e))
+        return {"ids": ids, "messages": messages}
+
+    def _get_raw_create_default(self, model, field):
+        """Compute the default value of a field for one record like default_get"""
+        value = field.convert_to_cache(field.default(model), model, validate=False)
+        return field.convert_to_write(field.convert_to_record(value, model), model)
+
+    def _get_raw_create_values(
+        self, model, row, values, flat_fields, references, converters, log
+    ):
+        """
+        Convert the values of a row
+        @param values: dict, the default values
+        @param flat_fields: list of the columns of the pattern
+        @param references: dict, the records referenced by the rows by column
+        @param converters: dict, the converter of each column
+        @param log: function called with the error messages of the row
+        @return: dict
+        """
+        for header, fname, subfname in flat_fields:
+            value = row.get(header)
+            if fname == "id":
+                continue
+            if value in ("", None):
+                values[fname] = False
+            elif subfname:
+                res_ids = references[header].get(value, [])
+                if len(res_ids) != 1:
+                    log(
+                        _("{} record found for the field {} with the value {}").format(
+                            len(res_ids), fname, value
+                        )
+                    )
+                    continue
+                values[fname] = res_ids[0]
+            else:
+                try:
+                    values[fname], __ = converters[fname](value)
+                except ValueError as e:
+                    log("{}: {}".format(model._fields[fname].string, e))
+        for fname, field in model._fields.items():
+            if (
+                not field.required
+                or not field.store
+                or field.compute
+                or fname in models.MAGIC_COLUMNS
+            ):
+                continue
+            value = values.get(fname)
+            if (
+                value is None
+                or value == ""
+                or (value is False and field.type != "boolean")
+            ):
+                log(_("Missing required value for the field {}").format(fname))
+        return values
+
+    def _check_raw_create_new_records(self, model, items, flat_fields, log):
+        """Refuse the rows of the records which already exist"""
+        for header, fname, subfname in flat_fields:
+            if subfname or not (fname == "id" or header.endswith(IDENTIFIER_SUFFIX)):
+                continue
+            values = {row[header] for __, row in items if row.get(header)}
+            if not values:
+                continue
+            if fname == "id":
+                existing = {value for value in values if not isinstance(value, str)}
+                xmlids = [
+                    tuple(value.split(".", 1))
+                    for value in values
+                    if isinstance(value, str) and "." in value
+                ]
+                if xmlids:
+                    self.env.cr.execute(
+                        """SELECT module || '.' || name FROM ir_model_data
+                        WHERE (module, name) IN %s""",
+                        (tuple(xmlids),),
+                    )
+                    existing.update(xmlid for xmlid, in self.env.cr.fetchall())
+            else:
+                existing = set(
+                    model.search([(fname, "in", list(values))]).mapped(fname)
+                )
+            for idx, row in items:
+                if row.get(header) in existing:
+                    log(
+                        idx,
+                        _("The record {} already exists, raw mode only creates").format(
+                            row[header]
+                        ),
+                    )
+
+    def _get_raw_create_references(self, model, items, flat_fields):
+        """
+        Search the records referenced by the many2one columns of all the rows
+        @return: dict {header: {value: list of ids}}
+        """
+        # the external ids of all the columns are resolved with one query
+        module = self._context.get("module", "__import__")
+        xmlids = {}
+        model.with_context(
+            pattern_import_xmlids=xmlids, _import_current_module=module
+        )._prefetch_import_xmlids(
+            [
+                {"id": row[header]}
+                for header, __, subfname in flat_fields
+                if subfname == "id"
+                for __, row in items
+                if isinstance(row.get(header), str)
+            ]
+        )
+        references = {}
+        for header, fname, subfname in flat_fields:
+            if not subfname:
+                continue
+            comodel = self.env[model._fields[fname].comodel_name]
+            values = {row[header] for __, row in items if row.get(header)}
+            references[header] = index = defaultdict(list)
+            if not values:
+                continue
+            if subfname == "id":
+                db_ids = [value for value in values if isinstance(value, int)]
+                for res_id in comodel.browse(db_ids).exists().ids:
+                    index[res_id].append(res_id)
+                for value in values:
+                    if not isinstance(value, str):
+                        continue
+                    xmlid = value if "." in value else module + "." + value
+                    res_model, res_id = xmlids.get(xmlid, (None, None))
+                    if res_model == comodel._name:
+                        index[value].append(res_id)
+            else:
+                records = comodel.search([(subfname, "in", list(values))])
+                for vals in records.read([subfname], load="_classic_write"):
+                    index[vals[subfname]].append(vals["id"])
+        return references
+
+    def _raw_insert(self, model, fnames, records_values):
+        """
+        Insert the rows with COPY, the ids are taken from the sequence
+        of the table beforehand
+        @return: list of ids
+        """
+        cr = self.env.cr
+        cr.execute(
+            "SELECT nextval(%s) FROM generate_series(1, %s)",
+            (model._sequence, len(records_values)),
+        )
+        ids = [row[0] for row in cr.fetchall()]
+        columns = ["id"] + fnames
+        magic_values = []
+        if model._log_access:
+            columns += ["create_uid", "create_date", "write_uid", "write_date"]
+            now = fields.Datetime.now()
+            magic_values = [self.env.uid, now, self.env.uid, now]
+        buf = StringIO()
+        writer = csv.writer(buf)
+        for res_id, values in zip(ids, records_values):
+            record = model.browse(res_id)
+            writer.writerow(
+                [res_id]
+                + [
+                    model._fields[fname].convert_to_column(
+                        values.get(fname, False), record, values
+                    )
+                    for fname in fnames
+                ]
+                + magic_values
             )
-            .env[self.model_id.model]
-            .load([], datas)
+        buf.seek(0)
+        cr.copy_expert(
+            'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                model._table, ", ".join('"{}"'.format(column) for column in columns)
+            ),
+            buf,
         )
+        model.invalidate_cache()
+        return ids
+
+    def _recompute_import_chunk(self, model):
+        """
+        Compute the stored computed fields of the records imported in bulk
+        @return: the error message if the computation failed
+        """
+        try:
+            model.recompute()
+        except Exception as e:
+            self.env.clear()
+            return str(e)
+        return None
+
+    def _set_import_result(self, patterned_import, res, count_skipped):
+        if res.get("memory_profile"):
+            patterned_import.memory_profile = res["memory_profile"]
         load_result = self._process_load_result(patterned_import, res)
         patterned_import.info = load_result[0]
         patterned_import.info_detail = load_result[1]
         patterned_import.status = load_result[2]
+        if patterned_import.dry_run:
+            patterned_import.info = (
+                _("Validation only, nothing has been imported.\n")
+                + patterned_import.info
+            )
+        if self.skip_unchanged_rows:
+            patterned_import.count_skipped_rows = count_skipped
+            if count_skipped:
+                patterned_import.info += _(
+                    "\nNumber of unchanged row skipped {}"
+                ).format(count_skipped)
+
+    def _read_patterned_import(self, patterned_import):
+        try:
+            attachment_data = base64.b64decode(patterned_import.datas.decode("utf-8"))
+            return self._read_import_data(attachment_data)
+        except Exception as e:
+            patterned_import.status = "fail"
+            patterned_import.info = _("Failed (check details)")
+            patterned_import.info_detail = e
+
+    @job(default_channel="root.importwithpattern")
+    def _generate_import_with_pattern_job(self, patterned_import):
+        datas = self._read_patterned_import(patterned_import)
+        stats = {"skipped": 0, "hashes": {}}
+        res = self._run_import(patterned_import, datas, stats)
+        self._save_import_row_hashes(patterned_import, res, stats["hashes"])
+        self._set_import_result(patterned_import, res, stats["skipped"])
+        return self._notify_user(patterned_import)
+
+    @api.multi
+    def _launch_import(self, patterned_import, description):
+        """
+        Delay the import of the file, split in several jobs if the pattern
+        allows parallel imports
+        """
+        self.ensure_one()
+        if self.import_job_count > 1 and not patterned_import.dry_run:
+            self.with_delay(
+                description=_("{} (split)").format(description)
+            )._split_import_job(patterned_import, description)
+        else:
+            self.with_delay(description=description)._generate_import_with_pattern_job(
+                patterned_import
+            )
+
+    def _get_row_partitions(self, rows):
+        """
+        Return the partition of each row, the existing records of the rows
+        are resolved in bulk from their .id, id and key columns
+        @param rows: list of tuple (row number, row)
+        @return: list of int
+        """
+        record_ids = self._get_row_record_ids([row for __, row in rows])
+        return [
+            self._get_row_partition(row_number, row, record_id=record_id)
+            for (row_number, row), record_id in zip(rows, record_ids)
+        ]
+
+    def _get_row_record_ids(self, rows):
+        """
+        Resolve the id of the existing record of each row with one query
+        for the external ids and one query per set of key columns
+        @param rows: list of dict
+        @return: list of id, None for the rows creating a record
+        """
+        model = self._get_import_model()
+        module = self._context.get("module", "__import__")
+        xmlids = {}
+        model.with_context(
+            pattern_import_xmlids=xmlids, _import_current_module=module
+        )._prefetch_import_xmlids(
+            [{"id": row["id"]} for row in rows if isinstance(row.get("id"), str)]
+        )
+        # only the key columns of the record itself, not of its relations
+        keys = [
+            {
+                header: value
+                for header, value in row.items()
+                if str(header).endswith(IDENTIFIER_SUFFIX)
+                and COLUMN_X2M_SEPARATOR not in str(header)
+            }
+            for row in rows
+        ]
+        key_index = model._get_key_index(keys)
+        record_ids = []
+        for row, key in zip(rows, keys):
+            record_id = None
+            if row.get(".id") not in (None, ""):
+                record_id = str(row[".id"]).isdigit() and int(row[".id"]) or None
+            elif isinstance(row.get("id"), str) and row["id"]:
+                xmlid = row["id"] if "." in row["id"] else module + "." + row["id"]
+                res_model, res_id = xmlids.get(xmlid, (None, None))
+                record_id = res_model == model._name and res_id or None
+            else:
+                index_key = model._get_o2m_index_key(key)
+                ids = index_key and key_index.get(index_key) or []
+                record_id = len(ids) == 1 and ids[0] or None
+            record_ids.append(record_id)
+        return record_ids
+
+    def _get_row_partition(self, row_number, row, record_id=None):
+        """
+        Rows updating the same record are always in the same partition so
+        a record is only written by one job, rows creating a record with the
+        same key too. Rows without key are spread by number.
+        @param record_id: id of the existing record of the row
+        """
+        if record_id:
+            key = "{},{}".format(self.model_id.model, record_id)
+        else:
+            key = self._get_row_key(row)
+        if key is None:
+            return row_number % self.import_job_count
+        # the builtin hash is randomized per process so it can't be used
+        return int(hashlib.sha1(key.encode()).hexdigest(), 16) % self.import_job_count
+
+    @job(default_channel="root.importwithpattern")
+    def _split_import_job(self, patterned_import, description=None):
+        """
+        Read the file once, stage its rows with their partition and delay
+        the import of each partition
+        """
+        datas = self._read_patterned_import(patterned_import)
+        if datas is None:
+            return self._notify_user(patterned_import)
+        self._stage_import_rows(patterned_import, datas, partitioned=True)
+        description = description or patterned_import.name
+        for partition in range(self.import_job_count):
+            partition = (
+                self.env["patterned.import.partition"]
+                .sudo()
+                .create(
+                    {"patterned_import_id": patterned_import.id, "partition": partition}
+                )
+            )
+            self.with_delay(
+                description=_("{} (part {}/{})").format(
+                    description, partition.partition + 1, self.import_job_count
+                )
+            )._generate_import_partition_job(patterned_import, partition)
+        return _("File split in {} parts").format(self.import_job_count)
+
+    def _read_staged_partition_rows(self, patterned_import, partition):
+        """
+        Iterate on the staged rows of a partition, the rows of the other
+        partitions are replaced by empty rows, ignored by the import, to
+        keep the line numbers of the messages
+        """
+        cr = self.env.cr
+        cr.execute(
+            """SELECT id FROM patterned_import_row
+            WHERE patterned_import_id = %s AND partition = %s
+            ORDER BY row_number""",
+            (patterned_import.id, partition),
+        )
+        staged_ids = [row[0] for row in cr.fetchall()]
+        last_row_number = 0
+        for ids in split_every(STAGING_CHUNK_SIZE, staged_ids):
+            # the rows are fetched before being yielded, the import
+            # uses the same cursor
+            cr.execute(
+                """SELECT row_number, data FROM patterned_import_row
+                WHERE id IN %s ORDER BY row_number""",
+                (ids,),
+            )
+            for row_number, data in cr.fetchall():
+                for __ in range(row_number - last_row_number - 1):
+                    yield {}
+                yield json.loads(data)
+                last_row_number = row_number
+
+    @job(default_channel="root.importwithpattern")
+    def _generate_import_partition_job(self, patterned_import, partition):
+        """
+        Import the staged rows of a partition. The result is always stored
+        on the partition, even if the import crashes, so the import can
+        be finalized once all the partitions are done.
+        """
+        stats = {"skipped": 0, "hashes": {}}
+        try:
+            with self.env.cr.savepoint():
+                res = self._run_import(
+                    patterned_import,
+                    self._read_staged_partition_rows(
+                        patterned_import, partition.partition
+                    ),
+                    stats,
+                )
+        except Exception as e:
+            if (
+                isinstance(e, OperationalError)
+                and e.pgcode in PG_CONCURRENCY_ERRORS_TO_RETRY
+            ):
+                # the job is retried
+                raise
+            self.env.clear()
+            res = {
+                "ids": [],
+                "messages": [
+                    {"type": "error", "message": str(e), "rows": {"from": 0, "to": 0}}
+                ],
+            }
+        self.env.cr.execute(
+            "DELETE FROM patterned_import_row "
+            "WHERE patterned_import_id = %s AND partition = %s",
+            (patterned_import.id, partition.partition),
+        )
+        patterned_import.invalidate_cache(["staged_row_ids"])
+        partition.write(
+            {
+                "done": True,
+                "record_ids": json.dumps(res["ids"] or []),
+                "messages": json.dumps(res["messages"]),
+                "count_skipped_rows": stats["skipped"],
+                "memory_profile": res.get("memory_profile"),
+                "row_hashes": json.dumps(stats["hashes"]),
+            }
+        )
+        # each partition delays the finalization, only the last one to
+        # finish sees all the partitions and sets the result
+        self.with_delay(
+            description=_("Finalize import {}").format(patterned_import.name)
+        )._finalize_partitioned_import(patterned_import)
+        return _("Partition {} imported").format(partition + 1)
+
+    @job(default_channel="root.importwithpattern")
+    def _finalize_partitioned_import(self, patterned_import):
+        self.env.cr.execute(
+            "SELECT status FROM patterned_import_export WHERE id = %s FOR UPDATE",
+            (patterned_import.id,),
+        )
+        partitions = (
+            self.env["patterned.import.partition"]
+            .sudo()
+            .search([("patterned_import_id", "=", patterned_import.id)])
+        )
+        if (
+            self.env.cr.fetchone()[0] != "pending"
+            or len(partitions) < self.import_job_count
+            or not all(partitions.mapped("done"))
+        ):
+            return _("Waiting for the other partitions")
+        ids = []
+        messages = []
+        row_hashes = {}
+        for partition in partitions:
+            ids += json.loads(partition.record_ids)
+            messages += json.loads(partition.messages)
+            row_hashes.update(json.loads(partition.row_hashes or "{}"))
+        messages.sort(key=lambda message: message.get("rows", {}).get("to", 0))
+        res = {
+            "ids": ids,
+            "messages": messages,
+            "memory_profile": "\n".join(
+                _("Partition {}: {}").format(
+                    partition.partition + 1, partition.memory_profile
+                )
+                for partition in partitions
+                if partition.memory_profile
+            ),
+        }
+        # the hashes are only saved once all the partitions succeeded
+        self._save_import_row_hashes(patterned_import, res, row_hashes)
+        self._set_import_result(
+            patterned_import, res, sum(partitions.mapped("count_skipped_rows"))
+        )
         return self._notify_user(patterned_import)
 
     def _notify_user(self, patterned_import_export):
@@ -51,6 +51,16 @@ class IrExportsLine(models.Model):
         "Value should be >= 1",
     )
 
+    o2m_layout = fields.Selection(
+        [("columns", "Columns"), ("sheet", "Separate sheet")],
+        string="One2many layout",
+        default="columns",
+        help="Columns: the columns of the sub-pattern are repeated for each "
+        "occurence on the row of the record.\n"
+        "Separate sheet: one row per related record on a sheet named like the "
+        "sub-pattern, with the number of the row of the parent record.",
+    )
+
     @api.model
     def _get_last_relation_field(self, model, path, level=1):
         if "/" not in path:
@@ -133,6 +143,26 @@ class IrExportsLine(models.Model):
                             )
                         )
 
+    @api.constrains("o2m_layout", "pattern_export_id", "name")
+    def _check_o2m_layout(self):
+        for record in self:
+            if record.o2m_layout == "sheet" and (
+                record.level != 1
+                or record.field1_id.ttype != "one2many"
+                or not record.pattern_export_id
+            ):
+                raise ValidationError(
+                    _(
+                        "The line {} can't be exported on a separate sheet: "
+                        "only the one2many fields of the pattern using a "
+                        "sub-pattern can"
+                    ).format(record.name)
+                )
+
+    @api.constrains("name", "number_occurence", "pattern_export_id", "o2m_layout")
+    def _check_raw_create(self):
+        self.mapped("export_id")._check_raw_create()
+
     @api.multi
     @api.depends("name")
     def _compute_related_level_field(self):
@@ -179,6 +209,8 @@ class IrExportsLine(models.Model):
         """
         headers = []
         for record in self:
+            if record.o2m_layout == "sheet":
+                continue
             if record.level == 0:
                 if use_description:
                     header = record.field1_id.field_description
@@ -223,6 +255,24 @@ class IrExportsLine(models.Model):
                             )
         return headers
 
+    def _get_key_lookup_fields(self):
+        """
+        Return the fields searched to find the record from the key
+        of the line (ex: country_id/code => res.partner.country_id and
+        res.country.code)
+        @return: list of tuple (model name, field name)
+        """
+        self.ensure_one()
+        result = []
+        model = self.export_id.resource
+        for field_name in self.name.split("/"):
+            field = self.env[model]._fields[field_name]
+            result.append((model, field_name))
+            if not field.relational:
+                break
+            model = field.comodel_name
+        return result
+
     def _get_tab_headers(self):
         self.ensure_one()
         return [self.last_field_id.name]
@@ -232,6 +282,9 @@ class IrExportsLine(models.Model):
             [getattr(record, self.last_field_id.name)] for record in permitted_records
         ]
 
+    def _get_tab_name(self):
+        return self.related_model_id.name + " (" + self.tab_filter_id.name + ")"
+
     def _get_tab_data(self):
         """
         :return: iterable of 4-tuples of format:
@@ -255,7 +308,7 @@ class IrExportsLine(models.Model):
             headers = rec._get_tab_headers()
             # TODO find a solution for this. Tab name maximum length
             #  is 31 characters on excel
-            name = rec.related_model_id.name + " (" + rec.tab_filter_id.name + ")"
+            name = rec._get_tab_name()
             if len(name) > 31:
                 raise UserWarning(
                     _(
@@ -282,5 +335,56 @@ class IrExportsLine(models.Model):
                 ] = rec.pattern_export_id.export_fields._get_dict_parser_for_pattern()
         return parser
 
+    def _get_x2many_limits_for_pattern(self):
+        """
+        Build a tree of the relational fields leading to a one2many or
+        many2many field with the number of related records to export.
+        Example: {"user_ids": {"limit": 3, "fields": {}}}
+        The limit is None for the many2one leading to a x2many field
+        @return: dict
+        """
+        limits = {}
+        for rec in self:
+            if not rec.level or rec.o2m_layout == "sheet":
+                continue
+            names = rec.name.split("/")
+            field_name, model, __ = rec._get_last_relation_field(
+                rec.export_id.resource, rec.name
+            )
+            if self.env[model]._fields[field_name].type not in (
+                "one2many",
+                "many2many",
+            ):
+                continue
+            node = limits
+            for name in names[: rec.level - 1]:
+                node = node.setdefault(name, {"limit": None, "fields": {}})["fields"]
+            self._merge_x2many_limits(
+                node,
+                names[rec.level - 1],
+                {
+                    "limit": rec.number_occurence,
+                    "fields": rec.pattern_export_id.export_fields._get_x2many_limits_for_pattern(),
+                },
+            )
+        return limits
+
+    def _merge_x2many_limits(self, limits, name, node):
+        """
+        Add the limits of a field to the tree, several lines can export the
+        same x2many field: the related records to export are the ones
+        needed by the line with the most occurrences
+        """
+        if name not in limits:
+            limits[name] = node
+            return
+        current = limits[name]
+        if current["limit"] is None or (
+            node["limit"] is not None and node["limit"] > current["limit"]
+        ):
+            current["limit"] = node["limit"]
+        for sub_name, sub_node in node["fields"].items():
+            self._merge_x2many_limits(current["fields"], sub_name, sub_node)
+
     def _get_json_parser_for_pattern(self):
         return convert_dict(self._get_dict_parser_for_pattern())
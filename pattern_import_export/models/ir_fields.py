@@ -2,12 +2,14 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import _, api, models
+from datetime import date
+
+from odoo import _, api, fields, models
 from odoo.osv import expression
 
 from odoo.addons.base.models import ir_fields
 
-from .common import IDENTIFIER_SUFFIX
+from .common import COLUMN_CONVERTED_TYPES, IDENTIFIER_SUFFIX
 
 
 class IrFieldsConverter(models.AbstractModel):
@@ -16,24 +18,75 @@ class IrFieldsConverter(models.AbstractModel):
     @api.model
     def for_model(self, model, fromtype=str):
         fn = super().for_model(model, fromtype=fromtype)
+        # the rows of a file share the same columns, the renaming of the
+        # key columns and the columns already converted by the flatty import
+        # are computed once per set of columns
+        header_infos = {}
+
+        def _get_header_info(record):
+            header = tuple(record)
+            if header not in header_infos:
+                header_infos[header] = self._get_header_info(model, header)
+            return header_infos[header]
 
         def fn_with_key_support(record, log):
-            cleanned = {}
-            keyfields = []
-            for field, vals in record.items():
-                if field.endswith(IDENTIFIER_SUFFIX):
-                    field = field.replace(IDENTIFIER_SUFFIX, "")
-                    keyfields.append(field)
-                cleanned[field] = vals
-            converted = fn(cleanned, log)
-            for field in keyfields:
-                converted["{}{}".format(field, IDENTIFIER_SUFFIX)] = converted.pop(
-                    field
-                )
+            key_mapping, typed_fields = _get_header_info(record)
+            typed_values = {
+                field: record[field]
+                for field, value_type in typed_fields.items()
+                if type(record[field]) is value_type
+            }
+            if typed_values:
+                record = {
+                    field: vals
+                    for field, vals in record.items()
+                    if field not in typed_values
+                }
+            if key_mapping:
+                record = {
+                    key_mapping.get(field, field): vals
+                    for field, vals in record.items()
+                }
+            converted = fn(record, log)
+            for keyfield, field in key_mapping.items():
+                converted[keyfield] = converted.pop(field)
+            for field, value in typed_values.items():
+                if isinstance(value, date):
+                    value = fields.Date.to_string(value)
+                converted[field] = value
             return converted
 
         return fn_with_key_support
 
+    @api.model
+    def _xmlid_to_record_id(self, xmlid, model):
+        # the external ids of the chunk resolved with one query
+        prefetched = self._context.get("pattern_import_xmlids", {}).get(xmlid)
+        if prefetched and prefetched[0] == model._name:
+            return prefetched[1]
+        return super()._xmlid_to_record_id(xmlid, model)
+
+    @api.model
+    def _get_header_info(self, model, header):
+        """
+        Return the renaming of the key columns and the python type of the
+        columns already converted by the flatty import
+        @param header: tuple of the columns of a row
+        @return: tuple (dict {key column: field}, dict {field: python type})
+        """
+        key_mapping = {
+            field: field[: -len(IDENTIFIER_SUFFIX)]
+            for field in header
+            if field and field.endswith(IDENTIFIER_SUFFIX)
+        }
+        typed_fields = {
+            field: COLUMN_CONVERTED_TYPES[model._fields[field].type]
+            for field in header
+            if field in model._fields
+            and model._fields[field].type in COLUMN_CONVERTED_TYPES
+        }
+        return key_mapping, typed_fields
+
     def _referencing_subfield(self, record):
         try:
             return super()._referencing_subfield(record)
@@ -51,43 +104,66 @@ class IrFieldsConverter(models.AbstractModel):
         if subfield in [".id", "id", None]:
             return super().db_id_for(model, field, subfield, value)
         else:
-            if value:
+            references = self._context.get("pattern_import_references", {}).get(
+                (field.model_name, field.name, subfield)
+            )
+            if references and isinstance(value, (str, int)) and value in references[0]:
+                # the record was searched with the other rows
+                record = self.env[field._related_comodel_name].browse(
+                    references[1].get(value, [])
+                )
+                self._check_referenced_record(record, subfield, value)
+            elif value:
                 # Only list domain are supported as they can be apply on server-side
                 if isinstance(field.domain, list):
                     domain = field.domain
                 else:
                     domain = []
                 domain = expression.AND([domain, [(subfield, "=", value)]])
-                if (
-                    self.env.context.get("pattern_import_export_model")
-                    == field._related_comodel_name
+                pending_values = self._context.get("pattern_import_pending_values")
+                # only the stored fields written by the rows are known, the
+                # computed and related fields can depend on any pending row
+                sub_field = self.env[field._related_comodel_name]._fields.get(subfield)
+                if self.env.context.get(
+                    "pattern_import_export_model"
+                ) == field._related_comodel_name and (
+                    pending_values is None
+                    or not sub_field
+                    or not sub_field.store
+                    or sub_field.compute
+                    or (subfield, value) in pending_values
+                    or (subfield, str(value)) in pending_values
                 ):
                     self._context["import_flush"]()
                 record = self.env[field._related_comodel_name].search(domain)
-                if len(record) > 1:
-                    raise self._format_import_error(
-                        ValueError,
-                        _(
-                            "Fail to process field '%%(field)s'.\n"
-                            "Too many records found for '%s' "
-                            "with the field '%s' and the value '%s'"
-                        ),
-                        (_(record._description), subfield, value),
-                    )
-                elif len(record) == 0:
-                    raise self._format_import_error(
-                        ValueError,
-                        _(
-                            "Fail to process field '%%(field)s'.\n"
-                            "No value found for model '%s' with the field '%s' "
-                            "and the value '%s'"
-                        ),
-                        (_(record._description), subfield, value),
-                    )
+                self._check_referenced_record(record, subfield, value)
             else:
                 record = self.env[field._related_comodel_name].browse()
             return record.id, subfield, []
 
+    @api.model
+    def _check_referenced_record(self, record, subfield, value):
+        if len(record) > 1:
+            raise self._format_import_error(
+                ValueError,
+                _(
+                    "Fail to process field '%%(field)s'.\n"
+                    "Too many records found for '%s' "
+                    "with the field '%s' and the value '%s'"
+                ),
+                (_(record._description), subfield, value),
+            )
+        elif len(record) == 0:
+            raise self._format_import_error(
+                ValueError,
+                _(
+                    "Fail to process field '%%(field)s'.\n"
+                    "No value found for model '%s' with the field '%s' "
+                    "and the value '%s'"
+                ),
+                (_(record._description), subfield, value),
+            )
+
     @api.model
     def _list_to_many2many(self, model, field, value):
         ids = []
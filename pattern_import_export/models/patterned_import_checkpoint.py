@@ -0,0 +1,22 @@
+#  Copyright (c) Akretion 2020
+#  License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html)
+
+from odoo import fields, models
+
+
+class PatternedImportCheckpoint(models.Model):
+    """Result of a chunk committed by a resumable import"""
+
+    _name = "patterned.import.checkpoint"
+    _description = "Committed chunk of a patterned import"
+    _order = "patterned_import_id, row_offset"
+    _log_access = False
+
+    patterned_import_id = fields.Many2one(
+        "patterned.import.export", required=True, ondelete="cascade", index=True
+    )
+    row_offset = fields.Integer(
+        required=True, help="Number of rows of the file processed with the chunk"
+    )
+    record_ids = fields.Text(help="Imported ids (json)")
+    messages = fields.Text(help="Messages of the import (json)")
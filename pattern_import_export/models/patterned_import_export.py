@@ -1,7 +1,9 @@
 #  Copyright (c) Akretion 2020
 #  License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html)
 
-from odoo import fields, models
+from datetime import timedelta
+
+from odoo import _, api, fields, models
 
 
 class PatternedImportExport(models.Model):
@@ -16,5 +18,126 @@ class PatternedImportExport(models.Model):
     )
     info = fields.Char()
     info_detail = fields.Char()
+    count_skipped_rows = fields.Integer(
+        string="Skipped rows", help="Number of unchanged rows skipped by the import"
+    )
+    dry_run = fields.Boolean(
+        string="Validation only", help="The file was only validated, not imported"
+    )
+    cache_key = fields.Char(
+        index=True,
+        readonly=True,
+        help="Key identifying the exported data, used to reuse the export",
+    )
+    upload_checksum = fields.Char(
+        index=True,
+        readonly=True,
+        help="Checksum of the uploaded file, the file of the attachment can "
+        "be rewritten with the result of the import",
+    )
+    memory_profile = fields.Text(
+        readonly=True, help="Memory used by the job and size of the chunks"
+    )
+    checkpoint_row = fields.Integer(
+        string="Committed rows",
+        readonly=True,
+        help="Number of rows already committed by a resumable import",
+    )
+    checkpoint_chunk_ids = fields.One2many(
+        "patterned.import.checkpoint", "patterned_import_id", readonly=True
+    )
+    staged_row_ids = fields.One2many("patterned.import.row", "patterned_import_id")
+    can_retry = fields.Boolean(compute="_compute_can_retry")
     kind = fields.Selection([("import", "import"), ("export", "export")], required=True)
     export_id = fields.Many2one("ir.exports", required=True, string="Export pattern")
+
+    @api.model
+    def create(self, vals):
+        record = super().create(vals)
+        if record.kind == "import":
+            record.upload_checksum = record.checksum
+        return record
+
+    @api.multi
+    def _compute_can_retry(self):
+        for record in self:
+            record.can_retry = record.status == "fail" and bool(
+                self.env["patterned.import.row"].search_count(
+                    [
+                        ("patterned_import_id", "=", record.id),
+                        ("status", "!=", "success"),
+                    ]
+                )
+            )
+
+    @api.multi
+    def action_retry_failed_rows(self):
+        self.ensure_one()
+        return {
+            "name": _("Retry failed rows"),
+            "type": "ir.actions.act_window",
+            "res_model": "patterned.import.retry",
+            "view_mode": "form",
+            "target": "new",
+            "context": {"default_patterned_import_id": self.id},
+        }
+
+    @api.multi
+    def _get_duplicated_import(self):
+        """
+        Return the import of the same file with the same pattern which
+        is still pending or was imported successfully.
+        The checksum is computed by the attachment when the file is uploaded.
+        """
+        self.ensure_one()
+        if not self.upload_checksum:
+            return self.browse()
+        return self.search(
+            [
+                ("id", "!=", self.id),
+                ("kind", "=", "import"),
+                ("export_id", "=", self.export_id.id),
+                ("upload_checksum", "=", self.upload_checksum),
+                ("status", "in", ("pending", "success")),
+                ("dry_run", "=", False),
+            ],
+            order="id desc",
+            limit=1,
+        )
+
+    @api.model
+    def _get_export_cache_limit_date(self):
+        max_age = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("pattern_import_export.export_cache_max_age", 24)
+        )
+        return fields.Datetime.now() - timedelta(hours=max_age)
+
+    @api.model
+    def _evict_export_cache(self):
+        """
+        Stop reusing the exports older than the maximum age (in hours) and the
+        oldest exports when the total size (in Mb) of the reusable exports
+        is over the limit. The exports are kept.
+        """
+        max_size = (
+            int(
+                self.env["ir.config_parameter"]
+                .sudo()
+                .get_param("pattern_import_export.export_cache_max_size", 500)
+            )
+            * 1024
+            * 1024
+        )
+        limit_date = self._get_export_cache_limit_date()
+        total_size = 0
+        evicted = self.browse()
+        for patterned_export in self.search(
+            [("kind", "=", "export"), ("cache_key", "!=", False)], order="id desc"
+        ):
+            total_size += patterned_export.file_size
+            if patterned_export.create_date < limit_date or total_size > max_size:
+                evicted |= patterned_export
+        evicted.write({"cache_key": False})
+        return True
@@ -0,0 +1,30 @@
+#  Copyright (c) Akretion 2020
+#  License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html)
+
+from odoo import fields, models
+
+
+class PatternedImportPartition(models.Model):
+    """Result of the job importing a part of a file"""
+
+    _name = "patterned.import.partition"
+    _description = "Partition of a patterned import"
+
+    patterned_import_id = fields.Many2one(
+        "patterned.import.export", required=True, ondelete="cascade"
+    )
+    partition = fields.Integer(required=True)
+    done = fields.Boolean()
+    record_ids = fields.Text(help="Imported ids (json)")
+    messages = fields.Text(help="Messages of the import (json)")
+    count_skipped_rows = fields.Integer()
+    row_hashes = fields.Text(help="Hashes of the imported rows (json)")
+    memory_profile = fields.Text()
+
+    _sql_constraints = [
+        (
+            "partition_uniq",
+            "unique(patterned_import_id, partition)",
+            "A partition can only be imported once",
+        )
+    ]
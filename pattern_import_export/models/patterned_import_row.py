@@ -0,0 +1,29 @@
+#  Copyright (c) Akretion 2020
+#  License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html)
+
+from odoo import fields, models
+
+
+class PatternedImportRow(models.Model):
+    """Row of an imported file, kept to only import again the failed rows"""
+
+    _name = "patterned.import.row"
+    _description = "Staged row of a patterned import"
+    _order = "patterned_import_id, row_number"
+    _log_access = False
+
+    patterned_import_id = fields.Many2one(
+        "patterned.import.export", required=True, ondelete="cascade", index=True
+    )
+    row_number = fields.Integer(required=True)
+    data = fields.Text(required=True, help="Content of the row (json)")
+    status = fields.Selection(
+        [("pending", "Pending"), ("fail", "Fail"), ("success", "Success")],
+        default="pending",
+        required=True,
+    )
+    partition = fields.Integer(
+        help="Part of the file imported by the same job, for the imports "
+        "split in several jobs"
+    )
+    messages = fields.Text(help="Messages of the last import of the row (json)")
@@ -0,0 +1,28 @@
+#  Copyright (c) Akretion 2020
+#  License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html)
+
+from odoo import fields, models
+
+
+class PatternedImportRowHash(models.Model):
+    """Hash of the last successfully imported content of a row.
+    Rows are identified by the value of their key columns (id, .id or #key)
+    """
+
+    _name = "patterned.import.row.hash"
+    _description = "Hash of imported row"
+    _log_access = False
+
+    export_id = fields.Many2one(
+        "ir.exports", required=True, ondelete="cascade", string="Export pattern"
+    )
+    key = fields.Char(required=True)
+    row_hash = fields.Char(required=True)
+
+    _sql_constraints = [
+        (
+            "export_key_uniq",
+            "unique(export_id, key)",
+            "The row key must be unique per pattern",
+        )
+    ]
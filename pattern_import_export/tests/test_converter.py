@@ -1,5 +1,6 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from datetime import date
 
 from odoo import api
 from odoo.tests.common import SavepointCase
@@ -49,3 +50,33 @@ class TestConvertID(SavepointCase):
         self._patch_search("res.country.state")
         self.converter.db_id_for(model, field, "name", "Rio de Janeiro")
         self.assertEqual(self.search_domain, [[("name", "=", "Rio de Janeiro")]])
+
+    def test_converted_columns_are_kept(self):
+        convert = self.converter.for_model(self.env["res.partner"])
+        messages = []
+        converted = convert(
+            {"ref#key": "foo", "credit_limit": 2.5, "date": date(2020, 1, 31)},
+            lambda field, error: messages.append(error),
+        )
+        self.assertEqual(messages, [])
+        self.assertEqual(
+            converted, {"ref#key": "foo", "credit_limit": 2.5, "date": "2020-01-31"}
+        )
+
+    def test_header_info_computed_once_per_header(self):
+        headers = []
+
+        @api.model
+        def _get_header_info(self, model, header):
+            headers.append(header)
+            return _get_header_info.origin(self, model, header)
+
+        self.converter._patch_method("_get_header_info", _get_header_info)
+        try:
+            convert = self.converter.for_model(self.env["res.partner"])
+            for name in ("foo", "bar", "baz"):
+                convert({"name": name, "ref#key": name}, lambda field, error: None)
+            convert({"name": "foo"}, lambda field, error: None)
+        finally:
+            self.converter._revert_method("_get_header_info")
+        self.assertEqual(headers, [("name", "ref#key"), ("name",)])
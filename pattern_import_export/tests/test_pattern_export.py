@@ -1,7 +1,15 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import base64
+import hashlib
+import os
+import threading
+from io import BytesIO
+from uuid import uuid4
+
 from odoo.tests.common import SavepointCase
 
+from ..models.common import MemoryGovernor
 from .common import ExportPatternCommon
 
 
@@ -334,3 +342,277 @@ class TestPatternExport(ExportPatternCommon, SavepointCase):
         results = self.ir_exports._get_data_to_export(self.partners)
         for result, expected_result in zip(results, expected_results):
             self.assertDictEqual(expected_result, result)
+
+    def test_key_index_warning(self):
+        self.env.ref("pattern_import_export.demo_export_line_3").write({"is_key": True})
+        self.assertIn("street", self.ir_exports.key_index_warning)
+        jobs = self.job_counter()
+        self.ir_exports.button_create_key_indexes()
+        self.assertEqual(jobs.count_created(), 1)
+        self.perform_jobs(jobs)
+        self.ir_exports.invalidate_cache()
+        self.assertFalse(self.ir_exports.key_index_warning)
+
+    def test_get_data_to_export_flat(self):
+        """
+        Ensure a pattern made of scalar and many2one fields is exported
+        without jsonify and give the same result
+        """
+        ir_exports = self.env["ir.exports"].create(
+            {
+                "name": "Flat partner",
+                "resource": "res.partner",
+                "is_pattern": True,
+                "export_fields": [
+                    (0, 0, {"name": name})
+                    for name in [
+                        "id",
+                        "name",
+                        "date",
+                        "create_date",
+                        "color",
+                        "is_company",
+                        "country_id/code",
+                        "parent_id/id",
+                    ]
+                ],
+            }
+        )
+        self.partner_1.date = "2020-05-01"
+        self.assertTrue(ir_exports._get_flat_fields())
+        records = self.partners | self.env.ref("base.res_partner_address_1")
+        results = list(ir_exports._get_data_to_export(records))
+        expected_results = list(
+            ir_exports.with_context(pattern_export_no_flat=True)._get_data_to_export(
+                records
+            )
+        )
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results, expected_results)
+        self.assertEqual(results[0]["date"], "2020-05-01")
+        self.assertEqual(results[0]["country_id|code"], "US")
+        self.assertEqual(results[3]["parent_id|id"], self.partner_1.id)
+
+    def test_get_data_to_export_not_flat(self):
+        self.assertIsNone(self.ir_exports._get_flat_fields())
+        self.assertIsNone(self.ir_exports_o2m._get_flat_fields())
+
+    def test_get_data_to_export_x2many_limits(self):
+        """
+        Ensure only the exported occurrences of x2many fields are serialized
+        """
+        limits = self.ir_exports_o2m.export_fields._get_x2many_limits_for_pattern()
+        self.assertEqual(
+            limits,
+            {
+                "user_ids": {
+                    "limit": 3,
+                    "fields": {"company_ids": {"limit": 1, "fields": {}}},
+                }
+            },
+        )
+        parser = self.ir_exports_o2m.export_fields._get_json_parser_for_pattern()
+        data = self.ir_exports_o2m._jsonify_with_limits(self.partner_1, parser, limits)[
+            0
+        ]
+        self.assertEqual(len(data["user_ids"]), 2)
+        for user_data in data["user_ids"]:
+            self.assertEqual(len(user_data["company_ids"]), 1)
+
+    def test_export_wizard_domain(self):
+        wizard = (
+            self.env["export.pattern.wizard"]
+            .with_context(
+                active_model="res.partner",
+                active_ids=self.partner_1.ids,
+                active_domain=[("id", "in", self.partners.ids)],
+            )
+            .create({"ir_exports_id": self.ir_exports.id})
+        )
+        self.assertTrue(wizard.has_domain)
+        # only the selected records are exported
+        jobs = self.job_counter()
+        wizard.run()
+        job = jobs.search_created()
+        self.assertEqual(job.method_name, "_generate_export_with_pattern_job")
+        self.assertEqual(job.record_ids, self.partner_1.ids)
+        # all the records matching the domain, the selected ids are the page
+        wizard.export_all_records = True
+        jobs = self.job_counter()
+        wizard.run()
+        job = jobs.search_created()
+        self.assertEqual(job.method_name, "_generate_export_with_domain_job")
+        self.assertEqual(job.args, [[["id", "in", self.partners.ids]]])
+
+    def test_export_cache_key_domain(self):
+        domain = [("id", "in", self.partners.ids)]
+        key = self.ir_exports_o2m._get_export_cache_key(
+            self.env["res.partner"].browse(), domain=domain
+        )
+        self.assertEqual(
+            key,
+            self.ir_exports_o2m._get_export_cache_key(
+                self.env["res.partner"].browse(), domain=domain
+            ),
+        )
+        self.user1.partner_id = self.partner_3
+        self.assertNotEqual(
+            key,
+            self.ir_exports_o2m._get_export_cache_key(
+                self.env["res.partner"].browse(), domain=domain
+            ),
+        )
+
+    def test_x2many_limits_merged(self):
+        self.env["ir.exports.line"].create(
+            {
+                "name": "company_ids/email",
+                "number_occurence": 2,
+                "export_id": self.ir_exports_m2m.id,
+            }
+        )
+        limits = self.ir_exports_m2m.export_fields._get_x2many_limits_for_pattern()
+        self.assertEqual(limits, {"company_ids": {"limit": 2, "fields": {}}})
+
+    def test_set_datas_from_file(self):
+        content = str(uuid4()).encode() + b"id,name\n" * 1000
+        attachment = self.env["ir.attachment"].create(
+            {"name": "export.csv", "datas_fname": "export.csv", "type": "binary"}
+        )
+        attachment._set_datas_from_file(BytesIO(content))
+        self.assertEqual(base64.b64decode(attachment.datas), content)
+        if attachment.store_fname:
+            # the file is garbage collected if the transaction aborts
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(
+                        attachment._full_path("checklist"), attachment.store_fname
+                    )
+                )
+            )
+        self.assertEqual(attachment.file_size, len(content))
+        self.assertEqual(attachment.checksum, hashlib.sha1(content).hexdigest())
+
+    def test_export_cache_key(self):
+        key = self.ir_exports_o2m._get_export_cache_key(self.partners)
+        self.assertEqual(key, self.ir_exports_o2m._get_export_cache_key(self.partners))
+        self.assertNotEqual(
+            key, self.ir_exports_o2m._get_export_cache_key(self.partner_1)
+        )
+        # a related record of a sub-pattern is removed
+        self.user1.partner_id = self.partner_3
+        self.assertNotEqual(
+            key, self.ir_exports_o2m._get_export_cache_key(self.partners)
+        )
+
+    def test_evict_export_cache(self):
+        self.empty_patterned_import_export.cache_key = "key"
+        self.env["patterned.import.export"]._evict_export_cache()
+        self.assertEqual(self.empty_patterned_import_export.cache_key, "key")
+        self.env["ir.config_parameter"].set_param(
+            "pattern_import_export.export_cache_max_age", -1
+        )
+        self.env["patterned.import.export"]._evict_export_cache()
+        self.assertFalse(self.empty_patterned_import_export.cache_key)
+
+    def test_memory_governor(self):
+        governor = MemoryGovernor(self.env, chunk_size=2, min_chunk_size=1)
+        # the memory used is always over the soft limit
+        governor.soft_limit = 1
+        governor.hard_limit = 0
+        chunks = list(governor.split(range(6)))
+        self.assertEqual(chunks, [[0, 1], [2], [3], [4], [5]])
+        self.assertIn("After chunk 1", governor.get_profile())
+        self.assertIn("Chunks: 5", governor.get_profile())
+
+    def test_get_data_to_export_domain(self):
+        domain = [("id", "in", self.partners.ids)]
+        governor = MemoryGovernor(self.env, chunk_size=1, min_chunk_size=1)
+        # keep the chunks of one record
+        governor.soft_limit = governor.hard_limit = 0
+        results = list(
+            self.ir_exports._get_data_to_export(
+                self.env["res.partner"].browse(), governor=governor, domain=domain
+            )
+        )
+        expected = list(self.ir_exports._get_data_to_export(self.partners.sorted("id")))
+        self.assertEqual(results, expected)
+        self.assertEqual(governor.nbr_chunks, len(self.partners))
+
+    def test_get_data_to_export_xmlid(self):
+        partner = self.env["res.partner"].create({"name": "No xmlid"})
+        self.ir_exports.export_xmlid = True
+        results = list(self.ir_exports._get_data_to_export(self.partner_1 | partner))
+        self.assertEqual(results[0]["id"], "base.res_partner_1")
+        self.assertEqual(results[1]["id"], partner.get_xml_id()[partner.id])
+        self.assertTrue(results[1]["id"].startswith("__export__.res_partner_"))
+
+    def test_write_rows_in_thread(self):
+        written = []
+
+        def writer(sink, metadata, rows):
+            for row in rows:
+                written.append((threading.current_thread().name, row["name"]))
+            sink.write(metadata["name"].encode())
+
+        sink = BytesIO()
+        rows = self.ir_exports._get_data_to_export(self.partners)
+        self.ir_exports._write_rows_in_thread(
+            writer, sink, self.ir_exports._get_export_metadata(), rows
+        )
+        self.assertEqual(
+            written,
+            [("pattern_export_writer", partner.name) for partner in self.partners],
+        )
+        self.assertEqual(sink.getvalue(), self.ir_exports.name.encode())
+
+        def failing_writer(sink, metadata, rows):
+            raise ValueError("Writer failed")
+
+        with self.assertRaises(ValueError):
+            self.ir_exports._write_rows_in_thread(
+                failing_writer, BytesIO(), {}, iter([{"name": "1"}] * 10)
+            )
+
+    def test_get_data_to_export_o2m_sheet(self):
+        self.env.ref(
+            "pattern_import_export.demo_export_o2m_line_3"
+        ).o2m_layout = "sheet"
+        self.assertEqual(self.ir_exports_o2m._get_header(), ["id", "name"])
+        result = list(self.ir_exports_o2m._get_data_to_export(self.partner_1))[0]
+        self.assertEqual(
+            result["user_ids"],
+            [
+                {
+                    "id": self.user2.id,
+                    "name": "Wood Corner",
+                    "company_ids|1|name": "Awesome company",
+                },
+                {
+                    "id": self.user1.id,
+                    "name": "Wood Corner",
+                    "company_ids|1|name": "Awesome company",
+                },
+            ],
+        )
+        row = self.ir_exports_o2m._merge_o2m_sheet_rows(
+            {"id": result["id"]}, {"user_ids": result["user_ids"]}
+        )
+        self.assertEqual(row["user_ids|2|id"], self.user1.id)
+        self.assertEqual(row["user_ids|1|company_ids|1|name"], "Awesome company")
+
+    def test_o2m_sheet_names(self):
+        line = self.env.ref("pattern_import_export.demo_export_o2m_line_3")
+        line.o2m_layout = "sheet"
+        line.pattern_export_id.name = "Users: [active/archived]?*" + "x" * 20
+        self.assertEqual(
+            self.ir_exports_o2m._get_o2m_sheet_names(),
+            {line: "Users_ _active_archived___xxxxx"},
+        )
+        # the sheet can't have the name of the main sheet
+        line.pattern_export_id.name = self.ir_exports_o2m.name.upper()
+        metadata = self.ir_exports_o2m._get_export_metadata()
+        self.assertEqual(
+            [sheet["name"] for sheet in metadata["sheets"]],
+            [self.ir_exports_o2m.name.upper() + " (2)"],
+        )
@@ -1,7 +1,10 @@
 # Copyright 2020 Akretion France (http://www.akretion.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from base64 import b64encode
+from datetime import date
 from uuid import uuid4
 
+from odoo.exceptions import ValidationError
 from odoo.tests.common import SavepointCase
 from odoo.tools import mute_logger
 
@@ -217,6 +220,253 @@ class TestPatternImport(ExportPatternCommon, SavepointCase):
         self.assertEquals(self.country_be, self.partner_3.country_id)
         self.assertEquals(self.partner_cat2, self.partner_3.category_id)
 
+    def test_bulk_import(self):
+        self.ir_exports.bulk_import = True
+        unique_name = str(uuid4())
+        main_data = [
+            {
+                "id": self.partner_1.get_xml_id().get(self.partner_1.id),
+                "name": unique_name,
+            }
+        ]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(self.empty_patterned_import_export.status, "success")
+        self.partner_1.invalidate_cache()
+        # the stored computed fields are computed after the chunk
+        self.assertEqual(self.partner_1.display_name, unique_name)
+
+    def test_raw_create(self):
+        ir_exports = self.env["ir.exports"].create(
+            {
+                "name": "Raw states",
+                "resource": "res.country.state",
+                "is_pattern": True,
+                "raw_create": True,
+                "export_fields": [
+                    (0, 0, {"name": name})
+                    for name in ["id", "name", "code", "country_id/code"]
+                ],
+            }
+        )
+        main_data = [
+            {
+                "id": "__import__.raw_state_1",
+                "name": "Raw 1",
+                "code": "R1",
+                "country_id|code": "FR",
+            },
+            {"name": "Raw 2", "code": "R2", "country_id|code": "FR"},
+        ]
+        with self._mock_read_import_data(main_data):
+            ir_exports._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(
+            self.empty_patterned_import_export.status,
+            "success",
+            self.empty_patterned_import_export.info,
+        )
+        states = self.env["res.country.state"].search([("code", "in", ["R1", "R2"])])
+        self.assertEqual(states.mapped("country_id"), self.env.ref("base.fr"))
+        self.assertEqual(self.env.ref("__import__.raw_state_1").name, "Raw 1")
+
+    def test_raw_create_xmlid_references(self):
+        model = self.env["res.country.state"]
+        items = [
+            (1, {"country_id|id": "base.fr"}),
+            (2, {"country_id|id": "base.be"}),
+            (3, {"country_id|id": "base.fr"}),
+            (4, {"country_id|id": "base.res_partner_1"}),
+            (5, {"country_id|id": "base.unknown_xmlid"}),
+        ]
+        references = self.ir_exports._get_raw_create_references(
+            model, items, [("country_id|id", "country_id", "id")]
+        )
+        self.assertEqual(
+            dict(references["country_id|id"]),
+            {"base.fr": [self.env.ref("base.fr").id], "base.be": [self.country_be.id]},
+        )
+
+    def test_raw_create_errors(self):
+        self.assertIn("logic on create", self.ir_exports._get_raw_create_error())
+        ir_exports = self.env["ir.exports"].create(
+            {
+                "name": "Raw states",
+                "resource": "res.country.state",
+                "is_pattern": True,
+                "raw_create": True,
+                "export_fields": [
+                    (0, 0, {"name": name})
+                    for name in ["name", "code", "country_id/code"]
+                ],
+            }
+        )
+        res = ir_exports._raw_create(
+            [
+                {"name": "Raw 1", "code": "R1", "country_id|code": "FR"},
+                {"name": "Raw 2", "code": "R2", "country_id|code": "XX"},
+                {"name": "Raw 3", "code": "R3"},
+            ]
+        )
+        self.assertFalse(res["ids"])
+        self.assertEqual([message["rows"]["to"] for message in res["messages"]], [2, 3])
+
+    def test_raw_create_access(self):
+        ir_exports = self.env["ir.exports"].create(
+            {
+                "name": "Raw states",
+                "resource": "res.country.state",
+                "is_pattern": True,
+                "raw_create": True,
+                "export_fields": [
+                    (0, 0, {"name": name})
+                    for name in ["name", "code", "country_id/code"]
+                ],
+            }
+        )
+        # the lines can not be changed to a field refused by the raw mode
+        with self.assertRaises(ValidationError):
+            ir_exports.export_fields.filtered(lambda line: line.name == "code").write(
+                {"name": "display_name"}
+            )
+        user = self.env["res.users"].create(
+            {
+                "name": "Raw user",
+                "login": str(uuid4()),
+                "groups_id": [(6, 0, self.env.ref("base.group_user").ids)],
+            }
+        )
+        res = ir_exports.sudo(user)._raw_create(
+            [{"name": "Raw 1", "code": "R1", "country_id|code": "FR"}]
+        )
+        self.assertFalse(res["ids"])
+        self.assertEqual(len(res["messages"]), 1)
+        self.assertFalse(self.env["res.country.state"].search([("code", "=", "R1")]))
+
+    def test_resumable_import(self):
+        self.ir_exports.resumable_import = True
+        # the first row was committed by a previous run of the job
+        self.empty_patterned_import_export.checkpoint_row = 1
+        self.env["patterned.import.checkpoint"].create(
+            {
+                "patterned_import_id": self.empty_patterned_import_export.id,
+                "row_offset": 1,
+                "record_ids": "[%s]" % self.partner_2.id,
+            }
+        )
+        name_1 = str(uuid4())
+        name_2 = str(uuid4())
+        main_data = [
+            {"id": self.partner_2.get_xml_id().get(self.partner_2.id), "name": name_1},
+            {"id": self.partner_1.get_xml_id().get(self.partner_1.id), "name": name_2},
+        ]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(self.empty_patterned_import_export.status, "success")
+        self.assertEqual(self.empty_patterned_import_export.checkpoint_row, 2)
+        self.assertEqual(
+            self.empty_patterned_import_export.checkpoint_chunk_ids.mapped(
+                "row_offset"
+            ),
+            [1, 2],
+        )
+        self.assertNotEqual(self.partner_2.name, name_1)
+        self.assertEqual(self.partner_1.name, name_2)
+
+    def test_staged_import_retry(self):
+        self.ir_exports.stage_import_rows = True
+        patterned_import = self.empty_patterned_import_export
+        name_1 = str(uuid4())
+        name_2 = str(uuid4())
+        main_data = [
+            {"id": self.partner_1.get_xml_id().get(self.partner_1.id), "name": name_1},
+            {
+                "id": self.partner_2.get_xml_id().get(self.partner_2.id),
+                "name": name_2,
+                "country_id|code": "XX",
+            },
+        ]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports._generate_import_with_pattern_job(patterned_import)
+        self.assertEqual(patterned_import.status, "fail")
+        self.assertEqual(
+            patterned_import.staged_row_ids.mapped("status"), ["pending", "fail"]
+        )
+        self.assertTrue(patterned_import.can_retry)
+        self.assertNotEqual(self.partner_1.name, name_1)
+        # the failed row is replaced by its line number
+        self.ir_exports._patch_staged_rows(
+            patterned_import,
+            [
+                {
+                    "#line": 2,
+                    "id": self.partner_2.get_xml_id().get(self.partner_2.id),
+                    "name": name_2,
+                    "country_id|code": "FR",
+                }
+            ],
+        )
+        self.ir_exports._retry_staged_import_job(patterned_import)
+        self.assertEqual(patterned_import.status, "success", patterned_import.info)
+        self.assertEqual(self.partner_1.name, name_1)
+        self.assertEqual(self.partner_2.name, name_2)
+        self.assertEqual(self.partner_2.country_id.code, "FR")
+
+    def test_create_in_batch(self):
+        created = []
+
+        def _load_records_create(self, values):
+            created.append(len(values))
+            return _load_records_create.origin(self, values)
+
+        self.partner_1.ref = "batch_parent"
+        main_data = [
+            {"name": str(uuid4()), "parent_id|ref": "batch_parent"},
+            {"name": str(uuid4()), "parent_id|ref": "batch_parent"},
+            {"name": str(uuid4()), "ref": "batch_new_parent"},
+            {"name": str(uuid4()), "parent_id|ref": "batch_new_parent"},
+        ]
+        self.env["res.partner"]._patch_method(
+            "_load_records_create", _load_records_create
+        )
+        try:
+            with self._mock_read_import_data(main_data):
+                self.ir_exports._generate_import_with_pattern_job(
+                    self.empty_patterned_import_export
+                )
+        finally:
+            self.env["res.partner"]._revert_method("_load_records_create")
+        self.assertEqual(
+            self.empty_patterned_import_export.status,
+            "success",
+            self.empty_patterned_import_export.info,
+        )
+        # the pending records are only flushed to find the new parent
+        self.assertEqual(created, [3, 1])
+
+    def test_lookup_computed_subfield_of_new_record(self):
+        name = str(uuid4())
+        main_data = [
+            {"name": name, "is_company": True},
+            {"name": str(uuid4()), "parent_id|commercial_company_name": name},
+        ]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(
+            self.empty_patterned_import_export.status,
+            "success",
+            self.empty_patterned_import_export.info,
+        )
+        company = self.env["res.partner"].search([("name", "=", name)])
+        self.assertEqual(len(company.child_ids), 1)
+
     def test_update_with_key(self):
         unique_name = str(uuid4())
         main_data = [{"login#key": self.user3.login, "name": unique_name}]
@@ -253,6 +503,31 @@ class TestPatternImport(ExportPatternCommon, SavepointCase):
         self.assertEquals(contact_1_name, contact_1.name)
         self.assertEquals(contact_2_name, contact_2.name)
 
+    def test_o2m_keys_searched_by_batch(self):
+        self.partner_1.ref = "o2m_main"
+        contact_1 = self.env.ref("base.res_partner_address_1")
+        contact_1.ref = "o2m_child_1"
+        rows = [
+            {"ref#key": "o2m_main", "child_ids|1|ref#key": "o2m_child_1"},
+            {"ref#key": "o2m_main", "child_ids|1|ref#key": "o2m_new_child"},
+            {"ref#key": "o2m_new_main", "child_ids|1|ref#key": "o2m_child_1"},
+        ]
+        results = self.env["res.partner"]._flatty2json_batch(rows)
+        self.assertEqual(
+            results,
+            [
+                [
+                    {".id": self.partner_1.id, "child_ids": [{".id": contact_1.id}]},
+                    None,
+                ],
+                [
+                    {".id": self.partner_1.id, "child_ids": [{"ref": "o2m_new_child"}]},
+                    None,
+                ],
+                [{"ref": "o2m_new_main", "child_ids": [{"ref": "o2m_child_1"}]}, None],
+            ],
+        )
+
     @mute_logger("odoo.sql_db")
     def test_wrong_import(self):
         main_data = [{"login#key": self.user3.login, "name": ""}]
@@ -397,3 +672,369 @@ class TestPatternImport(ExportPatternCommon, SavepointCase):
             [("name", "=", "Steve Jobs"), ("parent_id", "=", company.id)]
         )
         self.assertTrue(child_of_company)
+
+    def test_skip_unchanged_rows(self):
+        self.ir_exports_m2m.skip_unchanged_rows = True
+        unique_name = str(uuid4())
+        main_data = [{"login#key": self.user3.login, "name": unique_name}]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports_m2m._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(self.empty_patterned_import_export.status, "success")
+        self.assertEqual(self.empty_patterned_import_export.count_skipped_rows, 0)
+        self.assertEqual(self.user3.name, unique_name)
+        # the row didn't change so the record is not written
+        # even if the value in database is different
+        self.user3.name = "Changed outside of the import"
+        with self._mock_read_import_data(main_data):
+            self.ir_exports_m2m._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(self.empty_patterned_import_export.status, "success")
+        self.assertEqual(self.empty_patterned_import_export.count_skipped_rows, 1)
+        self.assertEqual(self.user3.name, "Changed outside of the import")
+        # a changed row is imported again
+        main_data = [{"login#key": self.user3.login, "name": unique_name + "2"}]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports_m2m._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(self.empty_patterned_import_export.count_skipped_rows, 0)
+        self.assertEqual(self.user3.name, unique_name + "2")
+
+    def test_unchanged_values_not_written(self):
+        written = []
+
+        def write(self, vals):
+            written.append(vals)
+            return write.origin(self, vals)
+
+        main_data = [
+            {
+                "login#key": self.user3.login,
+                "name": self.user3.name,
+                "company_ids|1|id": self.user3.company_ids.get_xml_id().get(
+                    self.user3.company_ids.id
+                ),
+            }
+        ]
+        self.env["res.users"]._patch_method("write", write)
+        try:
+            with self._mock_read_import_data(main_data):
+                self.ir_exports_m2m._generate_import_with_pattern_job(
+                    self.empty_patterned_import_export
+                )
+        finally:
+            self.env["res.users"]._revert_method("write")
+        self.assertEqual(
+            self.empty_patterned_import_export.status,
+            "success",
+            self.empty_patterned_import_export.info,
+        )
+        self.assertEqual(written, [])
+
+    def test_prefetch_import_xmlids(self):
+        xmlids = {}
+        rows = [
+            {
+                "id": "base.res_partner_1",
+                "category_id": [{"id": "base.res_partner_category_0"}],
+            },
+            {"id": "base.unknown_xmlid", "country_id": {"id": "base.fr"}},
+        ]
+        self.env["res.partner"].with_context(
+            pattern_import_xmlids=xmlids
+        )._prefetch_import_xmlids(rows)
+        self.assertEqual(
+            xmlids,
+            {
+                "base.res_partner_1": ("res.partner", self.partner_1.id),
+                "base.res_partner_category_0": (
+                    "res.partner.category",
+                    self.env.ref("base.res_partner_category_0").id,
+                ),
+                "base.fr": ("res.country", self.env.ref("base.fr").id),
+            },
+        )
+
+    def test_converter_reads_prefetched_xmlids(self):
+        country = self.env.ref("base.fr")
+        converter = self.env["ir.fields.converter"].with_context(
+            pattern_import_xmlids={
+                "__import__.prefetched_fr": ("res.country", country.id)
+            }
+        )
+        # the prefetched external ids are not limited like the import cache
+        self.assertEqual(
+            converter._xmlid_to_record_id(
+                "__import__.prefetched_fr", self.env["res.country"]
+            ),
+            country.id,
+        )
+
+    def test_many2many_written_by_difference(self):
+        categ_2 = self.env["res.partner.category"].create({"name": str(uuid4())})
+        self.partner_1.category_id = self.partner_cat1
+        commands = self.partner_1._remove_unchanged_x2m_commands(
+            self.partner_1._fields["category_id"], [(6, 0, [categ_2.id])]
+        )
+        self.assertEqual(commands, [(3, self.partner_cat1.id), (4, categ_2.id)])
+        commands = self.partner_1._remove_unchanged_x2m_commands(
+            self.partner_1._fields["category_id"], [(6, 0, self.partner_cat1.ids)]
+        )
+        self.assertEqual(commands, [])
+
+    def test_many2many_with_archived_record(self):
+        categ_2 = self.env["res.partner.category"].create({"name": str(uuid4())})
+        self.partner_1.category_id = self.partner_cat1 | categ_2
+        categ_2.active = False
+        field = self.partner_1._fields["category_id"]
+        commands = self.partner_1._remove_unchanged_x2m_commands(
+            field, [(6, 0, (self.partner_cat1 | categ_2).ids)]
+        )
+        self.assertEqual(commands, [])
+        # the archived record is still unlinked when it is not imported
+        commands = self.partner_1._remove_unchanged_x2m_commands(
+            field, [(6, 0, self.partner_cat1.ids)]
+        )
+        self.assertEqual(commands, [(3, categ_2.id)])
+
+    def test_dry_run(self):
+        self.empty_patterned_import_export.dry_run = True
+        ref = str(uuid4())
+        main_data = [
+            {"name": str(uuid4()), "country_id|code": "Fake"},
+            {"ref#key": ref, "name": ref},
+            {"ref#key": ref, "name": ref},
+        ]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        info = self.empty_patterned_import_export.info
+        self.assertEqual(self.empty_patterned_import_export.status, "fail")
+        self.assertIn("Validation only, nothing has been imported.", info)
+        self.assertIn(
+            "Line 1 : error, Fail to process field 'Country'.\n"
+            "No value found for model 'Country' with the field 'code' "
+            "and the value 'Fake'",
+            info,
+        )
+        self.assertIn("Line 3 : error, The key is already used on the line 2", info)
+        self.assertFalse(self.env["res.partner"].search([("ref", "=", ref)]))
+
+    def test_dry_run_searched_by_batch(self):
+        searched = []
+
+        def search(self, args, **kwargs):
+            searched.append(args)
+            return search.origin(self, args, **kwargs)
+
+        self.partner_1.ref = "dry_run_main"
+        rows = [
+            (1, {"ref#key": "dry_run_main", "country_id|code": "FR"}),
+            (2, {"name": str(uuid4()), "country_id|code": "BE"}),
+            (3, {"name": str(uuid4()), "country_id|code": "FR"}),
+            (4, {"name": str(uuid4()), "country_id|code": "Fake"}),
+        ]
+        self.env["res.country"]._patch_method("search", search)
+        try:
+            messages = self.env["res.partner"]._validate_flatty_rows(rows)
+        finally:
+            self.env["res.country"]._revert_method("search")
+        # the countries of all the rows are searched with one query
+        self.assertEqual(len(searched), 1)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["rows"], {"from": 4, "to": 4})
+        self.assertIn(
+            "No value found for model 'Country' with the field 'code' "
+            "and the value 'Fake'",
+            messages[0]["message"],
+        )
+
+    def test_dry_run_success(self):
+        self.empty_patterned_import_export.dry_run = True
+        name = str(uuid4())
+        main_data = [{"login#key": self.user3.login, "name": name}]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports_m2m._generate_import_with_pattern_job(
+                self.empty_patterned_import_export
+            )
+        self.assertEqual(
+            self.empty_patterned_import_export.status,
+            "success",
+            self.empty_patterned_import_export.info,
+        )
+        self.assertNotEqual(self.user3.name, name)
+
+    def test_partitioned_import(self):
+        self.ir_exports_m2m.import_job_count = 2
+        name = str(uuid4())
+        main_data = [
+            {"login#key": self.user3.login, "name": name},
+            {"login#key": self.user1.login, "name": name},
+            {"login#key": self.user3.login, "name": name + "2"},
+        ]
+        patterned_import = self.empty_patterned_import_export
+        jobs = self.job_counter()
+        # the file is read once, its rows are staged with their partition
+        with self._mock_read_import_data(main_data):
+            self.ir_exports_m2m._split_import_job(patterned_import)
+        self.assertEqual(jobs.count_created(), 2)
+        staged_rows = patterned_import.staged_row_ids
+        partitions = [
+            staged_rows.filtered(lambda r: r.partition == partition).mapped(
+                "row_number"
+            )
+            for partition in range(2)
+        ]
+        self.assertEqual(sorted(partitions[0] + partitions[1]), [1, 2, 3])
+        # rows with the same key are imported by the same job
+        self.assertTrue(
+            {1, 3}.issubset(partitions[0]) or {1, 3}.issubset(partitions[1])
+        )
+        for partition in self.env["patterned.import.partition"].search(
+            [("patterned_import_id", "=", patterned_import.id)], order="partition"
+        ):
+            self.ir_exports_m2m._generate_import_partition_job(
+                patterned_import, partition
+            )
+            if not partition.partition:
+                self.ir_exports_m2m._finalize_partitioned_import(patterned_import)
+                self.assertEqual(patterned_import.status, "pending")
+        self.ir_exports_m2m._finalize_partitioned_import(patterned_import)
+        self.assertEqual(patterned_import.status, "success", patterned_import.info)
+        self.assertFalse(patterned_import.staged_row_ids)
+        self.assertEqual(self.user1.name, name)
+        self.assertEqual(self.user3.name, name + "2")
+
+    def test_partition_by_record(self):
+        self.ir_exports_m2m.import_job_count = 7
+        rows = [
+            (1, {"id": self.user3.get_external_id()[self.user3.id], "name": "a"}),
+            (2, {".id": self.user3.id, "name": "b"}),
+            (3, {"login#key": self.user3.login, "name": "c"}),
+            (4, {".id": str(self.user3.id), "login#key": "other", "name": "d"}),
+        ]
+        partitions = self.ir_exports_m2m._get_row_partitions(rows)
+        # the rows of the same record are imported by the same job
+        self.assertEqual(len(set(partitions)), 1)
+        # the new records are spread by key
+        rows = [(1, {"login#key": "new_login"}), (2, {"login#key": "new_login"})]
+        partitions = self.ir_exports_m2m._get_row_partitions(rows)
+        self.assertEqual(partitions[0], partitions[1])
+
+    def test_partitioned_import_crash(self):
+        self.ir_exports_m2m.import_job_count = 2
+        patterned_import = self.empty_patterned_import_export
+        main_data = [{"login#key": self.user3.login, "name": str(uuid4())}]
+        with self._mock_read_import_data(main_data):
+            self.ir_exports_m2m._split_import_job(patterned_import)
+
+        def _run_import(self, patterned_import, datas, stats):
+            raise ValueError("Import crashed")
+
+        self.env["ir.exports"]._patch_method("_run_import", _run_import)
+        try:
+            for partition in self.env["patterned.import.partition"].search(
+                [("patterned_import_id", "=", patterned_import.id)]
+            ):
+                self.ir_exports_m2m._generate_import_partition_job(
+                    patterned_import, partition
+                )
+        finally:
+            self.env["ir.exports"]._revert_method("_run_import")
+        # the import is finalized even if the partitions crashed
+        self.ir_exports_m2m._finalize_partitioned_import(patterned_import)
+        self.assertEqual(patterned_import.status, "fail")
+
+    def test_load_record_id_from_xmlid(self):
+        xmlids = {"base.res_partner_1": ("res.partner", self.partner_1.id)}
+        partner = self.env["res.partner"]
+        self.assertEqual(
+            partner._get_load_record_id(
+                {"xml_id": "base.res_partner_1", "values": {}}, xmlids
+            ),
+            self.partner_1.id,
+        )
+        self.assertIsNone(
+            partner._get_load_record_id(
+                {"xml_id": "__import__.new_partner", "values": {}}, xmlids
+            )
+        )
+
+    def test_duplicated_import(self):
+        vals = {
+            "ir_exports_id": self.ir_exports.id,
+            "import_file": b64encode(str(uuid4()).encode()),
+            "filename": "partners.csv",
+        }
+        wizard_obj = self.env["import.pattern.wizard"]
+        imports = self.env["patterned.import.export"]
+        domain = [("export_id", "=", self.ir_exports.id), ("kind", "=", "import")]
+        self.assertEqual(wizard_obj.create(vals).action_launch_import(), {})
+        first_import = imports.search(domain)
+        self.assertEqual(len(first_import), 1)
+        action = wizard_obj.create(vals).action_launch_import()
+        self.assertEqual(action["res_id"], first_import.id)
+        self.assertEqual(imports.search(domain), first_import)
+        vals["force_import"] = True
+        self.assertEqual(wizard_obj.create(vals).action_launch_import(), {})
+        self.assertEqual(imports.search_count(domain), 2)
+
+    def test_convert_flatty_columns(self):
+        rows = [
+            {"name": "A", "credit_limit": "1.5", "color": 3, "active": "False"},
+            {"name": "B", "credit_limit": "wrong", "date": "2020-01-31"},
+            {"name": "C", "credit_limit": None, "active": True},
+        ]
+        self.env["res.partner"]._convert_flatty_columns(rows)
+        self.assertEqual(
+            rows,
+            [
+                {"name": "A", "credit_limit": 1.5, "color": 3, "active": False},
+                {"name": "B", "credit_limit": "wrong", "date": date(2020, 1, 31)},
+                {"name": "C", "credit_limit": None, "active": True},
+            ],
+        )
+
+    def test_convert_flatty_columns_mixed_cells(self):
+        # the invalid cells are isolated from the cast of the whole column
+        rows = [{"name": str(idx), "credit_limit": str(idx)} for idx in range(100)]
+        rows[3]["credit_limit"] = "wrong"
+        rows[50]["credit_limit"] = ""
+        rows[51]["credit_limit"] = None
+        rows[98]["credit_limit"] = "1,5"
+        rows[99]["credit_limit"] = 2
+        self.env["res.partner"]._convert_flatty_columns(rows)
+        expected = [float(idx) for idx in range(100)]
+        expected[3] = "wrong"
+        expected[50] = ""
+        expected[51] = None
+        expected[98] = "1,5"
+        expected[99] = 2.0
+        self.assertEqual([row["credit_limit"] for row in rows], expected)
+        self.assertEqual([row["name"] for row in rows], [str(i) for i in range(100)])
+
+    @mute_logger("odoo.sql_db")
+    def test_import_converted_columns(self):
+        rows = [
+            {"name": str(uuid4()), "credit_limit": "2.5", "date": "2020-01-31"},
+            {"name": str(uuid4()), "credit_limit": "wrong"},
+        ]
+        res = (
+            self.env["res.partner"]
+            .with_context(load_format="flatty")
+            .load([], [dict(row) for row in rows])
+        )
+        self.assertEqual(len(res["messages"]), 1)
+        self.assertEqual(res["messages"][0]["rows"], {"from": 2, "to": 2})
+        res = (
+            self.env["res.partner"]
+            .with_context(load_format="flatty")
+            .load([], rows[:1])
+        )
+        partner = self.env["res.partner"].browse(res["ids"])
+        self.assertEqual(partner.credit_limit, 2.5)
+        self.assertEqual(partner.date, date(2020, 1, 31))
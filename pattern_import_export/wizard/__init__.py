@@ -2,3 +2,4 @@
 
 from . import export_with_pattern
 from . import import_pattern_wizard
+from . import patterned_import_retry
@@ -15,6 +15,14 @@ class ExportPatternWizard(models.Model):
     no_export_pattern = fields.Boolean(
         string="No Export Pattern", compute="_compute_no_export_pattern"
     )
+    has_domain = fields.Boolean(
+        default=lambda s: s.env.context.get("active_domain") is not None
+    )
+    export_all_records = fields.Boolean(
+        string="Export all the matching records",
+        help="Export all the records matching the search of the list, "
+        "not only the selected records",
+    )
 
     @api.depends("model")
     @api.multi
@@ -26,6 +34,20 @@ class ExportPatternWizard(models.Model):
             if not ir_exports:
                 wiz.no_export_pattern = True
 
+    @api.multi
+    def _get_export_domain(self):
+        """
+        The list views always give their domain, even if only some records
+        are selected (and only the ids of the page when all the records
+        are selected): the domain is only used when asked
+        @return: domain or None
+        """
+        self.ensure_one()
+        active_domain = self.env.context.get("active_domain")
+        if self.export_all_records and active_domain is not None:
+            return active_domain
+        return None
+
     @api.multi
     def run(self):
         """
@@ -41,9 +63,19 @@ class ExportPatternWizard(models.Model):
                 export_name=wiz.ir_exports_id.name,
                 format=wiz.ir_exports_id.export_format,
             )
+            active_domain = wiz._get_export_domain()
+            if active_domain is not None:
+                # all the records matching the domain are selected, only
+                # give the domain to the job instead of all the ids
+                wiz.ir_exports_id.with_delay(
+                    description=description
+                )._generate_export_with_domain_job(active_domain)
+                continue
             records = self.env[wiz.model].browse(
                 self.env.context.get("active_ids", False)
             )
+            # the job reuses the export of the same records if it is up to
+            # date, the key of the export reads all the exported records
             records.with_delay(
                 description=description
             )._generate_export_with_pattern_job(wiz.ir_exports_id)
@@ -23,6 +23,15 @@ class ImportPatternWizard(models.TransientModel):
     )
     import_file = fields.Binary(String="File to import", required=True)
     filename = fields.Char()
+    force_import = fields.Boolean(
+        help="Import the file even if the same file is already pending or was "
+        "successfully imported with this pattern"
+    )
+    dry_run = fields.Boolean(
+        string="Validation only",
+        help="Only check the file: the rows are converted and the keys are "
+        "searched but nothing is written",
+    )
 
     def action_launch_import(self):
         """
@@ -38,6 +47,8 @@ class ImportPatternWizard(models.TransientModel):
             export_name=self.ir_exports_id.name,
             format=self.ir_exports_id.export_format,
         )
+        if self.dry_run:
+            description = _("Validate file of {}").format(description)
         patterned_import = self.env["patterned.import.export"].create(
             {
                 "name": self.filename,
@@ -45,9 +56,20 @@ class ImportPatternWizard(models.TransientModel):
                 "datas_fname": self.filename,
                 "kind": "import",
                 "export_id": self.ir_exports_id.id,
+                "dry_run": self.dry_run,
             }
         )
-        self.ir_exports_id.with_delay(
-            description=description
-        )._generate_import_with_pattern_job(patterned_import)
+        if not self.force_import and not self.dry_run:
+            duplicate = patterned_import._get_duplicated_import()
+            if duplicate:
+                patterned_import.attachment_id.unlink()
+                return {
+                    "name": _("File already imported"),
+                    "type": "ir.actions.act_window",
+                    "res_model": "patterned.import.export",
+                    "res_id": duplicate.id,
+                    "view_mode": "form",
+                    "target": "current",
+                }
+        self.ir_exports_id._launch_import(patterned_import, description)
         return {}
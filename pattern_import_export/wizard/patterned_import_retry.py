@@ -0,0 +1,42 @@
+# Copyright 2020 Akretion France (http://www.akretion.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import base64
+
+from odoo import _, fields, models
+
+
+class PatternedImportRetry(models.TransientModel):
+    """
+    Wizard importing again the failed rows of an import, with the rows
+    of an optional patch file replacing them
+    """
+
+    _name = "patterned.import.retry"
+    _description = "Retry the failed rows of a patterned import"
+
+    patterned_import_id = fields.Many2one(
+        "patterned.import.export", required=True, ondelete="cascade"
+    )
+    patch_file = fields.Binary(
+        help="File with the corrected rows, read with the pattern of the import. "
+        "Each row replaces the failed row with the same line number (given "
+        "by a '#line' column) or else with the same key."
+    )
+    filename = fields.Char()
+
+    def action_retry(self):
+        self.ensure_one()
+        patterned_import = self.patterned_import_id
+        export = patterned_import.export_id
+        if self.patch_file:
+            export._patch_staged_rows(
+                patterned_import,
+                export._read_import_data(base64.b64decode(self.patch_file)),
+            )
+        patterned_import.status = "pending"
+        export.with_delay(
+            description=_("Retry the failed rows of the import {}").format(
+                patterned_import.name
+            )
+        )._retry_staged_import_job(patterned_import)
+        return {}
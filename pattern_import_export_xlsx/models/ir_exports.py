@@ -2,6 +2,7 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 # pylint: disable=missing-manifest-dependency
 import base64
+from collections import defaultdict
 from io import BytesIO
 
 import openpyxl
@@ -11,6 +12,8 @@ from openpyxl.worksheet.datavalidation import DataValidation
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
+from odoo.addons.pattern_import_export.models.common import O2M_SHEET_PARENT_ROW
+
 
 class IrExports(models.Model):
     _inherit = "ir.exports"
@@ -20,64 +23,106 @@ class IrExports(models.Model):
         [("first", "First"), ("match_name", "Match Name")], default="first"
     )
 
+    @api.multi
+    def _get_export_metadata(self):
+        res = super()._get_export_metadata()
+        if self.export_format == "xlsx":
+            res["tabs"] = self.export_fields._get_tab_data()
+        return res
+
     @api.multi
     def _create_xlsx_file(self, records):
         self.ensure_one()
-        book = openpyxl.Workbook()
-        main_sheet = self._build_main_sheet_structure(book)
-        self._populate_main_sheet_rows(main_sheet, records)
-        tab_data = self.export_fields._get_tab_data()
-        self._create_tabs(book, tab_data)
-        main_sheet_length = len(records.ids) + 1
-        self._create_validators(main_sheet, main_sheet_length, tab_data)
-        book.close()
         xlsx_file = BytesIO()
-        book.save(xlsx_file)
+        self._export_rows_xlsx(
+            xlsx_file, self._get_export_metadata(), self._get_data_to_export(records)
+        )
         return xlsx_file
 
-    def _build_main_sheet_structure(self, book):
+    def _export_rows_xlsx(self, sink, metadata, rows):
+        """
+        Write the xlsx file in write-only mode: the rows are streamed to
+        the file instead of being kept in memory by openpyxl
+        @param sink: writable binary file object
+        @param metadata: dict returned by _get_export_metadata
+        @param rows: iterator of dict
+        """
+        book = openpyxl.Workbook(write_only=True)
+        main_sheet = self._build_main_sheet_structure(book, metadata)
+        o2m_sheets = self._build_o2m_sheets_structure(book, metadata)
+        nbr_rows = self._populate_main_sheet_rows(
+            main_sheet, metadata, rows, o2m_sheets=o2m_sheets
+        )
+        tab_data = metadata["tabs"]
+        self._create_tabs(book, tab_data)
+        main_sheet_length = metadata["row_start_records"] + nbr_rows - 1
+        self._create_validators(
+            main_sheet,
+            main_sheet_length,
+            tab_data,
+            row_start_records=metadata["row_start_records"],
+        )
+        book.save(sink)
+
+    def _build_main_sheet_structure(self, book, metadata):
         """
         Write main sheet header and other style details
         """
-        main_sheet = book["Sheet"]
-        main_sheet.title = self.name
-        if self.use_description:
-            for col, header in enumerate(
-                self._get_header(use_description=True), start=1
-            ):
-                main_sheet.cell(row=1, column=col, value=header)
-            for col, header in enumerate(self._get_header(), start=1):
-                main_sheet.cell(row=2, column=col, value=header)
-        else:
-            for col, header in enumerate(self._get_header(), start=1):
-                main_sheet.cell(row=1, column=col, value=header)
+        main_sheet = book.create_sheet(metadata["name"])
+        if metadata["description_headers"]:
+            main_sheet.append(metadata["description_headers"])
+        main_sheet.append(metadata["headers"])
         return main_sheet
 
-    def _populate_main_sheet_rows(self, main_sheet, records):
+    def _build_o2m_sheets_structure(self, book, metadata):
+        """
+        Create the sheets of the one2many exported on separate sheets
+        @return: list of tuple (sheet, key of the rows in the main row, headers)
+        """
+        o2m_sheets = []
+        for sheet_data in metadata["sheets"]:
+            sheet = book.create_sheet(sheet_data["name"])
+            if sheet_data["description_headers"]:
+                sheet.append(sheet_data["description_headers"])
+            sheet.append([O2M_SHEET_PARENT_ROW] + sheet_data["headers"])
+            o2m_sheets.append((sheet, sheet_data["key"], sheet_data["headers"]))
+        return o2m_sheets
+
+    def _populate_main_sheet_rows(self, main_sheet, metadata, rows, o2m_sheets=()):
         """
-        Get the actual data and write it row by row on the main sheet
+        Write the actual data row by row on the main sheet
+        and the related records on their own sheets
+        @return: number of rows written
         """
-        headers = self._get_header()
-        for row, values in enumerate(
-            self._get_data_to_export(records), start=self.row_start_records
-        ):
-            for col, header in enumerate(headers, start=1):
-                main_sheet.cell(row=row, column=col, value=values.get(header, ""))
+        headers = metadata["headers"]
+        nbr_rows = 0
+        for row_number, values in enumerate(rows, start=metadata["row_start_records"]):
+            main_sheet.append([values.get(header, "") for header in headers])
+            for sheet, key, sheet_headers in o2m_sheets:
+                for child_values in values.get(key) or []:
+                    sheet.append(
+                        [row_number]
+                        + [child_values.get(header, "") for header in sheet_headers]
+                    )
+            nbr_rows += 1
+        return nbr_rows
 
     def _create_tabs(self, book, tab_data):
         """ Create additional sheets for export lines with create tab option
         and write all valid choices """
         for name, headers, data, __ in tab_data:
             new_sheet = book.create_sheet(name)
-            for col_number, header in enumerate(headers, start=1):
-                new_sheet.cell(row=1, column=col_number, value=header)
-            for row_number, row_data in enumerate(data, start=2):
-                for col_number, cell_data in enumerate(row_data, start=1):
-                    new_sheet.cell(row=row_number, column=col_number, value=cell_data)
+            new_sheet.append(headers)
+            for row_data in data:
+                new_sheet.append(row_data)
 
-    def _create_validators(self, main_sheet, main_sheet_length, tab_data):
+    def _create_validators(
+        self, main_sheet, main_sheet_length, tab_data, row_start_records=None
+    ):
         """ Add validators: source permitted records from tab sheets,
         apply validation to main sheet """
+        if row_start_records is None:
+            row_start_records = self.row_start_records
         for el in tab_data:
             tab_name, _, data, col_dst = el
             col_letter_dst = get_column_letter(col_dst)
@@ -91,12 +136,13 @@ class IrExports(models.Model):
             validation = DataValidation(type="list", formula1=formula_range_src)
             range_dst = "${}${}:${}${}".format(
                 col_letter_dst,
-                str(self.row_start_records),
+                str(row_start_records),
                 col_letter_dst,
                 str(main_sheet_length),
             )
             validation.add(range_dst)
-            main_sheet.add_data_validation(validation)
+            # write-only worksheets write the validations when saved
+            main_sheet.data_validations.append(validation)
 
     @api.multi
     def _export_with_record_xlsx(self, records):
@@ -150,11 +196,11 @@ class IrExports(models.Model):
                 break
         return row + 1
 
-    @api.multi
-    def _read_import_data_xlsx(self, datafile):
+    def _read_worksheet_rows(self, worksheet):
+        """
+        @return: iterator of tuple (row number, dict)
+        """
         # note that columns and rows are 1-based
-        workbook = openpyxl.load_workbook(BytesIO(datafile), data_only=True)
-        worksheet = self._get_worksheet(workbook)
         headers = []
         real_last_column = self._find_real_last_column(worksheet)
         for col in range(real_last_column):
@@ -164,6 +210,33 @@ class IrExports(models.Model):
             elm = {}
             for col in range(real_last_column):
                 elm[headers[col]] = worksheet.cell(row, col + 1).value
+            yield row, elm
+
+    def _read_o2m_sheets_xlsx(self, workbook):
+        """
+        Read the sheets of the one2many exported on separate sheets
+        @return: dict {row number of the parent: {field name: list of dict}}
+        """
+        child_rows = defaultdict(lambda: defaultdict(list))
+        # the sheets are read with the names chosen by the export
+        for sheet_data in self._get_o2m_sheets_metadata():
+            name = sheet_data["name"]
+            if name not in workbook.sheetnames:
+                continue
+            for __, elm in self._read_worksheet_rows(workbook[name]):
+                parent_row = elm.pop(O2M_SHEET_PARENT_ROW, None)
+                if parent_row and any(elm.values()):
+                    child_rows[int(parent_row)][sheet_data["key"]].append(elm)
+        return child_rows
+
+    @api.multi
+    def _read_import_data_xlsx(self, datafile):
+        workbook = openpyxl.load_workbook(BytesIO(datafile), data_only=True)
+        worksheet = self._get_worksheet(workbook)
+        child_rows = self._read_o2m_sheets_xlsx(workbook)
+        for row, elm in self._read_worksheet_rows(worksheet):
+            if row in child_rows:
+                self._merge_o2m_sheet_rows(elm, child_rows[row])
             yield elm
 
     def _process_load_result_for_xls(self, attachment, res):
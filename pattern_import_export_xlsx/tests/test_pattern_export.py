@@ -204,3 +204,47 @@ class TestPatternExport(ExportPatternCommon, SavepointCase):
             ],
         ]
         self._helper_check_cell_values(main_sheet, expected_values)
+
+    def test_export_o2m_sheet(self):
+        self.env.ref(
+            "pattern_import_export.demo_export_o2m_line_3"
+        ).o2m_layout = "sheet"
+        wb = self._helper_get_resulting_wb(self.ir_exports_o2m, self.partners)
+        self._helper_check_headers(wb["Partner - O2M"], ["id", "name"])
+        sheet = wb["Users list - M2M"]
+        self._helper_check_headers(
+            sheet, ["#parent_row", "id", "name", "company_ids|1|name"]
+        )
+        expected_values = [
+            [2, self.user2.id, "Wood Corner", "Awesome company"],
+            [2, self.user1.id, "Wood Corner", "Awesome company"],
+            [3, self.user3.id, "Deco Addict", "YourCompany"],
+        ]
+        self._helper_check_cell_values(sheet, expected_values)
+        attachment = self._get_attachment(self.ir_exports_o2m)
+        rows = list(
+            self.ir_exports_o2m._read_import_data_xlsx(
+                base64.b64decode(attachment.datas)
+            )
+        )
+        self.assertEqual(rows[0]["user_ids|2|id"], self.user1.id)
+        self.assertEqual(rows[1]["user_ids|1|name"], "Deco Addict")
+        self.assertNotIn("user_ids|1|id", rows[2])
+
+    def test_export_o2m_sheet_name_used(self):
+        line = self.env.ref("pattern_import_export.demo_export_o2m_line_3")
+        line.o2m_layout = "sheet"
+        line.pattern_export_id.name = "Partner - O2M"
+        wb = self._helper_get_resulting_wb(self.ir_exports_o2m, self.partners)
+        self.assertEqual(wb.sheetnames, ["Partner - O2M", "Partner - O2M (2)"])
+        self._helper_check_headers(
+            wb["Partner - O2M (2)"], ["#parent_row", "id", "name", "company_ids|1|name"]
+        )
+        # the import reads the sheet with the name chosen by the export
+        attachment = self._get_attachment(self.ir_exports_o2m)
+        rows = list(
+            self.ir_exports_o2m._read_import_data_xlsx(
+                base64.b64decode(attachment.datas)
+            )
+        )
+        self.assertEqual(rows[0]["user_ids|2|id"], self.user1.id)
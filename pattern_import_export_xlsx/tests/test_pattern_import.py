@@ -131,6 +131,28 @@ class TestPatternImport(SavepointCase):
         self.assertEqual(contact_2.email, "raph-pattern@example.com")
         self.assertEqual(contact_2.function, "Store Manager")
 
+    def test_import_partners_already_imported(self):
+        self._load_file("example.partners.ok.xlsx", self.ir_export_partner)
+        patterned_import = self.env["patterned.import.export"].search(
+            [], limit=1, order="id desc"
+        )
+        self.assertEqual(patterned_import.status, "success")
+        # the file is detected even if the attachment was rewritten
+        # with the result of the import
+        data = base64.b64encode(open(PATH + "example.partners.ok.xlsx", "rb").read())
+        action = (
+            self.env["import.pattern.wizard"]
+            .create(
+                {
+                    "ir_exports_id": self.ir_export_partner.id,
+                    "import_file": data,
+                    "filename": "example.xlsx",
+                }
+            )
+            .action_launch_import()
+        )
+        self.assertEqual(action["res_id"], patterned_import.id)
+
     @mute_logger("odoo.sql_db")
     def test_import_partners_fail(self):
         """